@@ -0,0 +1,180 @@
+from model import Brand, Product, db
+import bisect
+
+"""
+    In-memory prefix indexes for brand and model name autocomplete.
+
+    Names are normalized (lower case, single spaces) and kept in a sorted
+    list, so finding everything that starts with what the user typed is a
+    binary search plus a walk over the matches. Every word of a name is
+    indexed too, so typing "face" finds "The North Face".
+
+    The indexes are built from the database the first time they're needed.
+    make_brand adds new brands and make_parent_product/update_parent_product
+    add model names as they're listed, and seed.clear_data throws both
+    indexes away when the tables are dropped.
+
+"""
+
+# Most suggestions to send back for one lookup.
+AUTOCOMPLETE_LIMIT = 10
+
+
+def normalize_name(name):
+    """ Lower cases a name and squashes runs of spaces, so "the  North face"
+        and "The North Face" are the same name.
+    """
+
+    return u' '.join(name.lower().split())
+
+
+class PrefixIndex(object):
+    """ Sorted array of normalized names for prefix searches.
+
+        Each name is stored with a value (e.g. a brand_id). Keys and entries
+        are parallel lists sorted by key.
+
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.entries = []
+
+    def __len__(self):
+        return len(set(self.entries))
+
+    def _insert(self, key, entry):
+        """Inserts one key unless it is already there for the same entry."""
+
+        idx = bisect.bisect_left(self.keys, key)
+
+        while idx < len(self.keys) and self.keys[idx] == key:
+            if self.entries[idx] == entry:
+                return
+            idx += 1
+
+        self.keys.insert(idx, key)
+        self.entries.insert(idx, entry)
+
+    def add(self, name, value):
+        """ Adds a name and its value. The whole name and every later word in
+            it (e.g. "north face", "face") can be searched by prefix.
+        """
+
+        entry = (name, value)
+        words = normalize_name(name).split(u' ')
+
+        for first in range(len(words)):
+            self._insert(u' '.join(words[first:]), entry)
+
+    def find(self, name):
+        """ Returns the value of a name that matches exactly once normalized,
+            or None.
+        """
+
+        key = normalize_name(name)
+        idx = bisect.bisect_left(self.keys, key)
+
+        while idx < len(self.keys) and self.keys[idx] == key:
+            found_name, value = self.entries[idx]
+
+            # Skip matches on a later word of a longer name.
+            if normalize_name(found_name) == key:
+                return value
+
+            idx += 1
+
+        return None
+
+    def search(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        """ Returns up to limit (name, value) tuples for names starting with
+            prefix (or with a word starting with prefix), in alphabetical
+            order by the matching part.
+        """
+
+        key = normalize_name(prefix)
+
+        if not key:
+            return []
+
+        results = []
+        seen = set()
+
+        for idx in xrange(bisect.bisect_left(self.keys, key), len(self.keys)):
+            if not self.keys[idx].startswith(key) or len(results) >= limit:
+                break
+
+            entry = self.entries[idx]
+
+            if entry not in seen:
+                seen.add(entry)
+                results.append(entry)
+
+        return results
+
+
+_brand_index = None
+_model_index = None
+
+
+def get_brand_index():
+    """ Returns the process-wide index of brand names to brand_ids, building
+        it from the Brands table the first time it's called.
+    """
+
+    global _brand_index
+
+    if _brand_index is None:
+        index = PrefixIndex()
+
+        for brand_id, brand_name in db.session.query(Brand.brand_id, Brand.brand_name):
+            index.add(brand_name, brand_id)
+
+        _brand_index = index
+
+    return _brand_index
+
+
+def get_model_index():
+    """ Returns the process-wide index of model names to their brand_ids,
+        building it from the Products table the first time it's called.
+    """
+
+    global _model_index
+
+    if _model_index is None:
+        index = PrefixIndex()
+        query = db.session.query(Product.model, Product.brand_id).distinct()
+
+        for model, brand_id in query:
+            if model:
+                index.add(model, brand_id)
+
+        _model_index = index
+
+    return _model_index
+
+
+def add_brand_to_index(brand):
+    """ Adds a new Brand to the brand index. Does nothing if the index hasn't
+        been built yet, since it will pick up the new row when it is.
+    """
+
+    if _brand_index is not None:
+        _brand_index.add(brand.brand_name, brand.brand_id)
+
+
+def add_model_to_index(model, brand_id):
+    """Same as add_brand_to_index, but for a product's model name."""
+
+    if _model_index is not None and model:
+        _model_index.add(model, brand_id)
+
+
+def clear_autocomplete_indexes():
+    """Throws away both indexes so they are rebuilt on next use."""
+
+    global _brand_index, _model_index
+
+    _brand_index = None
+    _model_index = None
@@ -0,0 +1,86 @@
+from model import Product, db
+import bisect
+import math
+
+"""
+    In-memory index of product availability windows.
+
+    A product is available for a rental from start_date to end_date if its
+    avail_start_date is on or before start_date and its avail_end_date is on
+    or after end_date. Looping over every product to check that is linear in
+    the number of products. The index sorts products by avail_start_date and
+    splits them into blocks, and keeps each block's avail_end_dates sorted, so
+    a query is a binary search for where the start dates stop matching, plus
+    one binary search per block before that. With blocks of about sqrt(n)
+    products that's O(sqrt(n) log n) plus the size of the answer.
+
+    Searches on the site go through the database, which has an index on
+    products(available, avail_start_date, avail_end_date) for the same
+    question. This is for admin tooling and scripts that ask lots of
+    availability questions about the same set of products.
+
+"""
+
+
+class AvailabilityIndex(object):
+    """ Answers "which products are available for this whole window?" """
+
+    def __init__(self, windows=(), block_size=None):
+        """ Takes in an iterable of (prod_id, avail_start_date,
+            avail_end_date) tuples and an optional block size.
+        """
+
+        windows = sorted(windows, key=lambda window: window[1])
+
+        if block_size is None:
+            block_size = max(64, int(math.sqrt(len(windows))))
+
+        self.block_size = block_size
+        self.starts = [window[1] for window in windows]
+        # Each block is (ends, prod_ids), both sorted by avail_end_date.
+        self.blocks = []
+
+        for first in range(0, len(windows), block_size):
+            block = sorted(windows[first:first + block_size],
+                           key=lambda window: window[2])
+            self.blocks.append(([window[2] for window in block],
+                                [window[0] for window in block]))
+
+        # The one block that only partly matches a query gets checked window
+        # by window, in start date order.
+        self.windows = windows
+
+    def __len__(self):
+        return len(self.windows)
+
+    @classmethod
+    def from_db(cls):
+        """Builds an index of the products currently marked available."""
+
+        query = db.session.query(Product.prod_id, Product.avail_start_date,
+                                 Product.avail_end_date).filter(
+                                 Product.available == True)
+
+        return cls(query.all())
+
+    def available(self, start_date, end_date):
+        """ Returns a list of prod_ids available from start_date to end_date
+            (inclusive), in no particular order.
+        """
+
+        # Everything before this position has avail_start_date <= start_date.
+        num_started = bisect.bisect_right(self.starts, start_date)
+        num_full_blocks = num_started // self.block_size
+
+        prod_ids = []
+
+        for ends, block_prod_ids in self.blocks[:num_full_blocks]:
+            prod_ids.extend(block_prod_ids[bisect.bisect_left(ends, end_date):])
+
+        # The block the start dates stop matching in is only partly in
+        # range, so check it one product at a time.
+        for prod_id, avail_start, avail_end in self.windows[num_full_blocks * self.block_size:num_started]:
+            if avail_end >= end_date:
+                prod_ids.append(prod_id)
+
+        return prod_ids
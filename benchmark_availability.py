@@ -0,0 +1,94 @@
+from availability_index import AvailabilityIndex
+from datetime import datetime, timedelta
+import random
+import sys
+import time
+
+"""
+    Compares AvailabilityIndex to the product loop in
+    search_helpers.get_products_within_dates on made up products.
+
+    Run with: python benchmark_availability.py [number of products ...]
+    (defaults to 10,000, 100,000, and 1,000,000).
+
+"""
+
+
+class FakeProduct(object):
+    """Just the Product attributes get_products_within_dates looks at."""
+
+    __slots__ = ('prod_id', 'available', 'avail_start_date', 'avail_end_date')
+
+    def __init__(self, prod_id, avail_start_date, avail_end_date):
+        self.prod_id = prod_id
+        self.available = True
+        self.avail_start_date = avail_start_date
+        self.avail_end_date = avail_end_date
+
+
+def make_products(num_products, first_day):
+    """ Makes products available for 1 to 180 days, starting some time in the
+        year after first_day.
+    """
+
+    products = []
+
+    for prod_id in xrange(1, num_products + 1):
+        start = first_day + timedelta(days=random.randint(0, 365))
+        end = start + timedelta(days=random.randint(1, 180))
+        products.append(FakeProduct(prod_id, start, end))
+
+    return products
+
+
+def loop_available(products, start_date, end_date):
+    """Same check as get_products_within_dates, without the users."""
+
+    available_products = []
+
+    for product in products:
+        if product.available and (product.avail_start_date <= start_date) and (product.avail_end_date >= end_date):
+            available_products.append(product.prod_id)
+
+    return available_products
+
+
+def run_benchmark(num_products, num_queries=20):
+    random.seed(num_products)
+    first_day = datetime(2016, 1, 1)
+    products = make_products(num_products, first_day)
+
+    windows = []
+
+    for i in range(num_queries):
+        start = first_day + timedelta(days=random.randint(0, 400))
+        windows.append((start, start + timedelta(days=random.randint(0, 7))))
+
+    start_time = time.time()
+    index = AvailabilityIndex((product.prod_id, product.avail_start_date,
+                               product.avail_end_date) for product in products)
+    build_seconds = time.time() - start_time
+
+    start_time = time.time()
+    loop_results = [loop_available(products, start, end) for start, end in windows]
+    loop_seconds = (time.time() - start_time) / num_queries
+
+    start_time = time.time()
+    index_results = [index.available(start, end) for start, end in windows]
+    index_seconds = (time.time() - start_time) / num_queries
+
+    for loop_result, index_result in zip(loop_results, index_results):
+        assert sorted(loop_result) == sorted(index_result)
+
+    avg_matches = sum(len(result) for result in loop_results) / num_queries
+
+    print "%9d products: build %.3fs, loop %.2fms/query, index %.2fms/query (%.0fx), ~%d matches" % (
+        num_products, build_seconds, loop_seconds * 1000, index_seconds * 1000,
+        loop_seconds / index_seconds, avg_matches)
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+
+    for size in sizes:
+        run_benchmark(size)
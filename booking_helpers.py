@@ -0,0 +1,162 @@
+from model import History, Product, db
+from loading_profiles import for_account_requests, for_account_rentals
+from sqlalchemy import tuple_
+from datetime import datetime
+
+"""
+    Helper functions for checking and making bookings.
+
+    A booking is a rental History: the product is reserved from its
+    start_date to its end_date (inclusive). Products stay available between
+    bookings, so an item rented for one weekend still shows up in searches
+    for other dates. The histories table has an index on
+    (prod_id, start_date, end_date) so overlap checks stay fast for products
+    with lots of bookings.
+
+    book_product locks the product's row while it checks for overlapping
+    bookings and adds the new one, so two people renting the same product at
+    the same moment can't both get it. Bookings for different products don't
+    wait on each other.
+
+    The account page lists an owner's rental requests and a renter's rentals
+    newest first, a page at a time. Those are ORDER BY rental_submission_date
+    DESC queries on the (prod_id, rental_submission_date) and
+    (renter_user_id, rental_submission_date) indexes, paged with a cursor
+    like the search results, so a page costs the same however long the
+    history is.
+
+"""
+
+# Rows per page in the account page's history tables.
+HISTORY_PAGE_SIZE = 10
+
+HISTORY_CURSOR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def overlapping_bookings(start_date, end_date):
+    """ Makes a query for histories that overlap a date range. Two ranges
+        overlap if each one starts on or before the day the other one ends.
+    """
+
+    return History.query.filter(History.start_date <= end_date,
+                                History.end_date >= start_date)
+
+
+def find_booked_products(prod_ids, start_date, end_date):
+    """ Takes in a list of prod_ids and a date range, and returns the set of
+        those prod_ids that are already booked for any part of the range.
+    """
+
+    if not prod_ids:
+        return set()
+
+    query = overlapping_bookings(start_date, end_date).filter(
+        History.prod_id.in_(prod_ids)).with_entities(History.prod_id).distinct()
+
+    return set(prod_id for (prod_id,) in query)
+
+
+def is_product_free(prod_id, start_date, end_date):
+    """ Returns True if a product has no bookings overlapping a date range."""
+
+    query = overlapping_bookings(start_date, end_date).filter(
+        History.prod_id == prod_id)
+
+    return not db.session.query(query.exists()).scalar()
+
+
+def book_product(prod_id, renter_user_id, start_date, end_date, num_days):
+    """ Books a product for a renter if it's free for the whole date range.
+
+        Locks the product's row (SELECT ... FOR UPDATE) until the booking is
+        committed, so concurrent bookings of the same product take turns and
+        the second one sees the first one's History.
+
+        Returns the new History, or None if the product is already booked for
+        any of the dates.
+
+    """
+
+    product = Product.query.filter(Product.prod_id == prod_id).with_for_update().one()
+
+    if not is_product_free(prod_id, start_date, end_date):
+        # Release the lock.
+        db.session.rollback()
+        return None
+
+    history = History(prod_id=prod_id, renter_user_id=renter_user_id,
+                      start_date=start_date, end_date=end_date,
+                      total_cost=product.price_per_day * num_days)
+
+    db.session.add(history)
+    db.session.commit()
+
+    return history
+
+
+def encode_history_cursor(history):
+    """ Makes a cursor string for the page of histories after this one, from
+        its rental_submission_date and history_id.
+    """
+
+    return "%s:%d" % (history.rental_submission_date.strftime(HISTORY_CURSOR_DATE_FORMAT),
+                      history.history_id)
+
+
+def decode_history_cursor(cursor_string):
+    """ Turns a cursor string from encode_history_cursor back into a tuple of
+        (rental_submission_date, history_id). Raises ValueError if it's not a
+        valid cursor.
+    """
+
+    date_string, history_id = cursor_string.rsplit(":", 1)
+
+    return (datetime.strptime(date_string, HISTORY_CURSOR_DATE_FORMAT), int(history_id))
+
+
+def page_of_histories(query, cursor=None, page_size=HISTORY_PAGE_SIZE):
+    """ Gets one page of a History query, newest rental_submission_date first
+        (ties broken by history_id).
+
+        Takes in the query, optionally the (rental_submission_date,
+        history_id) cursor of where the page starts, and the page size.
+        Returns a list of histories and the cursor string for the next page,
+        or None if this is the last page.
+
+    """
+
+    if cursor is not None:
+        query = query.filter(tuple_(History.rental_submission_date,
+                                    History.history_id) < cursor)
+
+    histories = query.order_by(History.rental_submission_date.desc(),
+                               History.history_id.desc()).limit(page_size + 1).all()
+
+    next_cursor = None
+
+    if len(histories) > page_size:
+        histories = histories[:page_size]
+        next_cursor = encode_history_cursor(histories[-1])
+
+    return histories, next_cursor
+
+
+def get_owner_histories(owner_user_id, cursor=None, page_size=HISTORY_PAGE_SIZE):
+    """ Gets a page of rentals of an owner's products, with the renters and
+        products the account page shows. Returns a list of histories and the
+        next page's cursor string (see page_of_histories).
+    """
+
+    query = History.query.join(Product, Product.prod_id == History.prod_id).filter(
+        Product.owner_user_id == owner_user_id).options(*for_account_requests())
+
+    return page_of_histories(query, cursor, page_size)
+
+
+def get_renter_histories(renter_user_id, cursor=None, page_size=HISTORY_PAGE_SIZE):
+    """Same as get_owner_histories, but for the things a user has rented."""
+
+    query = History.query.filter(History.renter_user_id == renter_user_id).options(
+        *for_account_rentals())
+
+    return page_of_histories(query, cursor, page_size)
@@ -1,5 +1,9 @@
 from unittest import TestCase
 import os
+import json
+import tempfile
+import threading
+import time
 from mock import patch
 from datetime import datetime
 from server import app
@@ -8,15 +12,58 @@ from seed import load_regions, load_users, load_bestuses, load_categories
 from seed import load_brands, load_products, load_tents, load_filltypes
 from seed import load_gendertypes, load_sleepingbags, load_padtypes
 from seed import load_sleepingpads, load_ratings, load_histories, load_test_postalcodes
-from seed import clear_data
-from model import User, Brand, Product, Tent, SleepingBag, Category, Rating
-from model import SleepingPad, PostalCode
+from seed import clear_data, BulkInserter, sync_data
+from model import User, Brand, Product, Tent, SleepingBag, Category, Rating, History
+from model import SleepingPad, PostalCode, ZipDistance, ZipDistanceCenter, Region
 from make_update_helpers import check_brand, make_brand, get_brand_id
-from make_update_helpers import make_postalcode
+from make_update_helpers import make_postalcode, update_search_vector
 from search_helpers import get_users_in_area, filter_products, convert_string_to_datetime
 from search_helpers import get_products_within_dates, categorize_products, calc_Haversine_distance
 from make_update_helpers import calc_avg_star_rating
-from search_helpers import search_radius, calc_default_dates
+from search_helpers import search_radius, calc_default_dates, calc_Haversine_distances
+from search_helpers import search_products, decode_cursor, cached_search_products
+from search_helpers import count_search_facets, get_search_center
+from search_cache import search_result_cache, SearchResultCache
+from postalcode_index import get_postalcode_index
+from distance_helpers import get_nearby_postalcodes, invalidate_zip_distances
+from distance_helpers import calc_bounding_boxes, ensure_zip_distances
+from geocoder import geocode, GeocodeCache
+from getridofduplicates import dedupe_postalcodes
+from availability_index import AvailabilityIndex
+from booking_helpers import is_product_free, find_booked_products
+from booking_helpers import get_owner_histories, get_renter_histories, decode_history_cursor
+from rating_helpers import get_rating_summary, rebuild_rating_summaries
+from db_config import get_db_profile, pool_metrics
+from reference_data import get_reference_data
+from autocomplete import get_brand_index
+
+
+# Most SQL statements each route may run (warmed up, so one-time work like
+# building the postal code index or filling zip_distances isn't counted).
+# These are what each route ran against Postgres when last measured, and they
+# don't grow with the number of rows a page shows, so going over one usually
+# means a template started lazy loading a relationship per row.
+SEARCH_URL = ('/search-results?search_area=94612&search_miles=20'
+              '&search_start_date=2015-12-01&search_end_date=2015-12-02'
+              '&category_id=-1&brand_id=-1')
+
+QUERY_BUDGETS = {'/account-info': 4,
+                 SEARCH_URL: 6,
+                 '/show-owner-ratings/1': 3,
+                 '/show-renter-ratings/5': 3,
+                 '/show-product-ratings/1': 4,
+                 '/product-detail/1': 1,
+                 '/product-detail/5': 1,
+                 '/edit-listing/3': 1,
+                 }
+
+
+# A search with nothing cached, as measured: building the postal code index,
+# the user, saving the center's zip_distances (check, lock, recheck, bounding
+# box, delete, insert, center), the categories, one query per category, the
+# reference data for the form (7 tables), then the user and center again for
+# the facet counts, the facet counts, and the ratings.
+COLD_SEARCH_BUDGET = 24
 
 
 class IntegrationTestCase(TestCase):
@@ -26,7 +73,7 @@ class IntegrationTestCase(TestCase):
         app.config['TESTING'] = True
         postgrespassword = os.environ['POSTGRES_PASSWORD']
         db_uri = 'postgresql://' + postgrespassword + '/test'
-        connect_to_db(app, db_uri)
+        connect_to_db(app, db_uri, 'test')
 
         db.create_all()
 
@@ -209,6 +256,144 @@ class IntegrationTestCase(TestCase):
         sleepingpad = SleepingPad.query.get(product.prod_id)
         self.assertEqual(sleepingpad.type_code, 'F')
 
+    def test_listing_existing_brand_by_name(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'trix@rabbit.com'
+
+            # A "new" brand that's really The North Face typed differently.
+            result = c.post('/handle-listing/3', data={'category_id': 3,
+                            'brand_id': -1, 'new_brand_name': 'the  north face',
+                            'modelname': 'Mega Mat 10', 'desc': 'mega big and mega warm',
+                            'cond': 'mega good', 'avail_start': '2017-03-01',
+                            'avail_end': '2017-06-15', 'pricing': 2.50, 'image': None,
+                            'padtype': 'F', 'bestuse': 2, 'r_val': 9.5,
+                            'pad_weight': 38, 'pad_length': '78'},
+                            follow_redirects=True)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(Brand.query.filter(Brand.brand_name.ilike('%north face')).count(), 1)
+
+        product = Product.query.filter(Product.model == 'Mega Mat 10').one()
+        self.assertEqual(product.brand.brand_name, 'The North Face')
+
+    def test_listing_brand_added_by_another_process(self):
+        get_brand_index()
+
+        # Big Agnes is added by another process, so it isn't in this
+        # process's brand index.
+        db.session.add(Brand(brand_name='Big Agnes'))
+        db.session.commit()
+
+        with app.test_request_context('/handle-listing/3', method='POST',
+                                      data={'new_brand_name': 'big agnes'}):
+            brand_id = check_brand(-1)
+
+        self.assertEqual(Brand.query.get(brand_id).brand_name, 'Big Agnes')
+        self.assertEqual(Brand.query.filter(Brand.brand_name.ilike('big agnes')).count(), 1)
+        self.assertEqual(get_brand_index().find('Big Agnes'), brand_id)
+
+    def test_listing_blank_brand(self):
+        num_brands = Brand.query.count()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'trix@rabbit.com'
+
+            result = c.post('/handle-listing/3', data={'category_id': 3,
+                            'brand_id': -1, 'new_brand_name': '   ',
+                            'modelname': 'Blank Mat', 'desc': 'no brand',
+                            'cond': 'good', 'avail_start': '2017-03-01',
+                            'avail_end': '2017-06-15', 'pricing': 2.50, 'image': None,
+                            'padtype': 'F', 'bestuse': 2, 'r_val': 9.5,
+                            'pad_weight': 38, 'pad_length': '78'})
+
+        self.assertEqual(result.status_code, 302)
+        self.assertTrue(result.headers['Location'].endswith('/list-product/3'))
+        self.assertEqual(Brand.query.count(), num_brands)
+        self.assertEqual(Product.query.filter(Product.model == 'Blank Mat').count(), 0)
+
+    def test_autocomplete(self):
+        result = self.client.get('/autocomplete?field=brand&q=nor')
+        self.assertEqual(json.loads(result.data)['results'],
+                         [{'name': 'The North Face', 'brand_id': 3}])
+
+        make_brand("Nemo")
+        result = self.client.get('/autocomplete?field=brand&q=ne')
+        self.assertIn('Nemo', [brand['name'] for brand in json.loads(result.data)['results']])
+
+        result = self.client.get('/autocomplete?field=model&q=passage')
+        self.assertEqual(json.loads(result.data)['results'],
+                         [{'name': 'Passage 2', 'brand_id': 1}])
+
+    def test_handle_rental(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'count@chocula.com'
+                sess['search_start_date'] = datetime(2016, 1, 8)
+                sess['search_end_date'] = datetime(2016, 1, 10)
+                sess['num_days'] = 3
+                sess['search_area'] = '94612'
+                sess['search_radius'] = 20
+                sess['search_category_id'] = -1
+                sess['search_brand_id'] = -1
+
+            result = c.post('/handle-rental/1', follow_redirects=True)
+
+            self.assertEqual(result.status_code, 200)
+            self.assertIn('Rental finalized!', result.data)
+            self.assertEqual(Product.query.get(1).available, True)
+
+            # The same dates can't be booked twice.
+            result = c.post('/handle-rental/1', follow_redirects=True)
+            self.assertIn('was just booked', result.data)
+            self.assertEqual(History.query.filter(History.prod_id == 1,
+                                                  History.start_date == datetime(2016, 1, 8)).count(), 1)
+
+    def test_concurrent_rentals(self):
+        renters = ['count@chocula.com', 'trix@rabbit.com', 'elsie@cow.com',
+                   'spuds@mackenzie.com', 'phar@fignewton.com']
+        prod_ids = [1, 3, 12]
+        start_date = datetime(2016, 2, 1)
+        end_date = datetime(2016, 2, 3)
+
+        winners = []
+
+        def rent(prod_id, renter):
+            client = app.test_client()
+
+            with client.session_transaction() as sess:
+                sess['user'] = renter
+                sess['search_start_date'] = start_date
+                sess['search_end_date'] = end_date
+                sess['num_days'] = 3
+
+            result = client.post('/handle-rental/%d' % prod_id)
+
+            if result.headers['Location'].endswith('/account-info'):
+                winners.append(prod_id)
+
+        threads = [threading.Thread(target=rent, args=(prod_id, renter))
+                   for prod_id in prod_ids for renter in renters]
+
+        started = time.time()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - started
+
+        print "\n%d concurrent rentals in %.3fs (%.1f rentals/s)\n" % (
+            len(threads), elapsed, len(threads) / elapsed)
+
+        self.assertEqual(sorted(winners), prod_ids)
+
+        for prod_id in prod_ids:
+            self.assertEqual(History.query.filter(History.prod_id == prod_id,
+                                                  History.start_date == start_date).count(), 1)
+
     def test_submit_renter_rating(self):
         result = self.client.post('handle-user-rating', data={'hist_id': 7,
                                   'num_stars': 3, 'is_owner': 0, 'comments': 'abcdefg'},
@@ -233,6 +418,120 @@ class IntegrationTestCase(TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn('history_id=7', result.data)
 
+    def test_query_budgets(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'phar@fignewton.com'
+
+            for url, budget in sorted(QUERY_BUDGETS.items()):
+                c.get(url)
+                result = c.get(url)
+
+                self.assertEqual(result.status_code, 200)
+                self.assertLessEqual(int(result.headers['X-Query-Count']), budget,
+                                     '%s ran %s queries (budget %d)' % (
+                                         url, result.headers['X-Query-Count'], budget))
+
+    def test_cold_search_query_budget(self):
+        search_result_cache.clear()
+        ZipDistance.query.delete()
+        ZipDistanceCenter.query.delete()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'phar@fignewton.com'
+
+            result = c.get(SEARCH_URL)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertLessEqual(int(result.headers['X-Query-Count']), COLD_SEARCH_BUDGET,
+                             'cold search ran %s queries (budget %d)' % (
+                                 result.headers['X-Query-Count'], COLD_SEARCH_BUDGET))
+
+    def test_search_again_form_starts_over(self):
+        start_date = convert_string_to_datetime('2015-12-01')
+        end_date = convert_string_to_datetime('2015-12-02')
+        inventory, next_cursors = search_products('94612', 20, 2, start_date,
+                                                  end_date, 1, -1, page_size=1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'count@chocula.com'
+
+            result = c.get('/search-results?search_area=94612&search_miles=20'
+                           '&search_start_date=2015-12-01&search_end_date=2015-12-02'
+                           '&category_id=1&brand_id=-1&cursor_1=' + next_cursors['Tents'])
+
+        # Changing the search from a later page starts from the first page,
+        # so the form doesn't send the cursors back.
+        self.assertEqual(result.status_code, 200)
+        self.assertNotIn('name="cursor_', result.data)
+
+    def test_search_results_next_page_with_accents(self):
+        for prod_id in [1, 3]:
+            Product.query.get(prod_id).description = u'Pitched it at the caf\xe9 tent site.'
+            db.session.commit()
+            update_search_vector(prod_id)
+
+        def search_one_per_page(*args, **kwargs):
+            return cached_search_products(*args, page_size=1, **kwargs)
+
+        with patch('server.cached_search_products', search_one_per_page):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['user'] = 'count@chocula.com'
+
+                result = c.get('/search-results?search_area=94612&search_miles=20'
+                               '&search_start_date=2015-12-01&search_end_date=2015-12-02'
+                               '&category_id=1&brand_id=-1&keywords=caf%C3%A9+tent')
+
+        # The "more results" link keeps the keywords, UTF-8 encoded.
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('keywords=caf%C3%A9+tent', result.data)
+
+    def test_show_ratings_pages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'franken@berry.com'
+
+            result = c.get('/show-owner-ratings/1')
+            self.assertEqual(result.status_code, 200)
+            self.assertIn('REI: Passage 2', result.data)
+
+            result = c.get('/show-renter-ratings/5')
+            self.assertEqual(result.status_code, 200)
+
+            result = c.get('/show-product-ratings/1')
+            self.assertEqual(result.status_code, 200)
+            self.assertIn('3 ratings', result.data)
+
+    def test_rating_summaries(self):
+        # Product 1 has ratings of 4, 3, and 3 stars in the seed data.
+        summary = get_rating_summary('product', 1)
+        self.assertEqual((summary.num_ratings, summary.total_stars), (3, 10))
+        self.assertEqual(summary.histogram(), [(4, 1), (3, 2), (2, 0), (1, 0)])
+
+        before = get_rating_summary('product', 3).num_ratings
+        self.client.post('handle-product-rating', data={'hist_id': 7,
+                         'num_stars': 2, 'comments': 'abcdefg'})
+        db.session.expire_all()
+        summary = get_rating_summary('product', 3)
+        self.assertEqual(summary.num_ratings, before + 1)
+
+        # Re-rating replaces the old stars instead of counting twice.
+        self.client.post('handle-product-rating', data={'hist_id': 7,
+                         'num_stars': 4, 'comments': 'changed my mind'})
+        db.session.expire_all()
+        summary = get_rating_summary('product', 3)
+        self.assertEqual(summary.num_ratings, before + 1)
+        self.assertEqual(summary.stars_2, 0)
+
+        # Rebuilding from the histories gets the same totals.
+        num_ratings = summary.num_ratings
+        rebuild_rating_summaries()
+        self.assertEqual(get_rating_summary('product', 3).num_ratings, num_ratings)
+
     def test_delist_product(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -305,6 +604,160 @@ class IntegrationTestCase(TestCase):
 
         self.assertEqual(products[0].prod_id, 1)
 
+    def test_bookings(self):
+        self.assertFalse(is_product_free(1, datetime(2015, 7, 5), datetime(2015, 7, 6)))
+        self.assertFalse(is_product_free(1, datetime(2015, 6, 30), datetime(2015, 7, 1)))
+        self.assertTrue(is_product_free(1, datetime(2015, 11, 1), datetime(2015, 11, 3)))
+
+        self.assertEqual(find_booked_products([1, 2, 9], datetime(2015, 12, 11),
+                                              datetime(2015, 12, 12)), set([9]))
+
+        # Product 9 is booked December 10-15, but the rest of its dates are
+        # still searchable.
+        start_date = convert_string_to_datetime('2015-12-11')
+        end_date = convert_string_to_datetime('2015-12-12')
+        products = get_products_within_dates(start_date, end_date, [User.query.get(1)])
+        self.assertNotIn(9, [product.prod_id for product in products])
+
+        start_date = convert_string_to_datetime('2015-12-20')
+        end_date = convert_string_to_datetime('2015-12-21')
+        products = get_products_within_dates(start_date, end_date, [User.query.get(1)])
+        self.assertIn(9, [product.prod_id for product in products])
+
+    def test_db_profiles(self):
+        self.assertEqual(get_db_profile('dev')['echo'], True)
+        self.assertEqual(get_db_profile('prod')['echo'], False)
+
+        with patch.dict(os.environ, {'HAPPYCAMPER_ENV': 'prod', 'DB_POOL_SIZE': '20',
+                                     'DB_PRE_PING': 'false'}):
+            profile = get_db_profile()
+            self.assertEqual(profile['pool_size'], 20)
+            self.assertEqual(profile['pre_ping'], False)
+
+        self.assertRaises(ValueError, get_db_profile, 'staging')
+
+        # Without HAPPYCAMPER_ENV we get prod settings, not dev's SQL echo.
+        with patch.dict(os.environ, {}):
+            os.environ.pop('HAPPYCAMPER_ENV', None)
+            self.assertEqual(get_db_profile()['echo'], False)
+            self.assertEqual(get_db_profile()['pre_ping'], True)
+
+        # Running queries checks connections out of the metered pool.
+        pool_metrics.clear()
+        Product.query.get(1)
+        db.session.remove()
+        stats = pool_metrics.stats(db.engine.pool)
+        self.assertGreaterEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['timeouts'], 0)
+
+    def test_reference_data(self):
+        reference = get_reference_data()
+        self.assertIs(get_reference_data(), reference)
+        self.assertEqual(reference.brands[0].brand_name, 'REI')
+        user = User.query.get(1)
+        self.assertEqual(reference.regions_by_id[user.region_id].abbr, user.region.abbr)
+
+        # Adding a brand makes the next lookup reload.
+        make_brand("Nemo")
+        self.assertIsNot(get_reference_data(), reference)
+        self.assertIn('Nemo', [brand.brand_name for brand in get_reference_data().brands])
+
+    def test_sync_data(self):
+        num_brands = Brand.query.count()
+
+        Region.query.get(1).full = 'Californ'
+        db.session.delete(PostalCode.query.get(94612))
+        db.session.commit()
+        make_brand("ABC")
+
+        sync_data(['regions', 'brands', 'users', 'test_postalcodes'])
+
+        self.assertEqual(Region.query.get(1).full, 'California')
+        self.assertEqual(Region.query.get(1).abbr, 'CA')
+        self.assertIsNotNone(PostalCode.query.get(94612))
+        self.assertEqual(User.query.get(1).email, 'franken@berry.com')
+        # Brands the app added are kept, and seeded brands keep their ids.
+        self.assertEqual(Brand.query.count(), num_brands + 1)
+        self.assertEqual(Brand.query.get(1).brand_name, 'REI')
+
+        # Tables matched on file position, and deletes from tables the app
+        # adds to, are refused before anything changes.
+        self.assertRaises(ValueError, sync_data, ['regions', 'products'])
+        self.assertRaises(ValueError, sync_data, ['brands'], True)
+        self.assertEqual(Brand.query.count(), num_brands + 1)
+
+    def test_sync_postalcodes_keeps_distances(self):
+        db.session.add(PostalCode(postalcode=94999, latitude=37.81, longitude=-122.25))
+        db.session.commit()
+
+        for center in [94612, 92277, 10013]:
+            ensure_zip_distances(center, 20)
+
+        # Nothing changed, so every center keeps its saved distances.
+        sync_data(['test_postalcodes'])
+        self.assertEqual(ZipDistanceCenter.query.count(), 3)
+
+        # Only centers near a moved or deleted postal code are thrown away,
+        # and saved distances to a deleted one don't stop it being deleted.
+        PostalCode.query.get(94608).latitude = 37.9
+        db.session.commit()
+
+        sync_data(['test_postalcodes'], True)
+        self.assertIsNone(PostalCode.query.get(94999))
+        self.assertEqual(PostalCode.query.get(94608).latitude, 37.823254)
+        self.assertEqual(sorted(center.center for center in ZipDistanceCenter.query),
+                         [10013, 92277])
+        self.assertEqual(ZipDistance.query.filter(ZipDistance.center == 94612).count(), 0)
+
+    def test_history_pages(self):
+        all_histories = History.query.join(Product).filter(Product.owner_user_id == 1).all()
+        expected = sorted(all_histories, reverse=True,
+                          key=lambda history: (history.rental_submission_date,
+                                               history.history_id))
+
+        histories = []
+        cursor = None
+
+        while True:
+            page, next_cursor = get_owner_histories(1, cursor, page_size=2)
+            self.assertLessEqual(len(page), 2)
+            histories.extend(page)
+
+            if next_cursor is None:
+                break
+
+            cursor = decode_history_cursor(next_cursor)
+
+        self.assertEqual([history.history_id for history in histories],
+                         [history.history_id for history in expected])
+
+        rentals, next_cursor = get_renter_histories(5)
+        self.assertTrue(all(history.renter_user_id == 5 for history in rentals))
+
+    def test_availability_index(self):
+        start_date = convert_string_to_datetime('2016-04-01')
+        end_date = convert_string_to_datetime('2016-05-01')
+
+        index = AvailabilityIndex.from_db()
+        expected = [product.prod_id for product in
+                    get_products_within_dates(start_date, end_date, User.query.all())]
+
+        self.assertEqual(sorted(index.available(start_date, end_date)), sorted(expected))
+
+        # Tiny blocks so the query has to cross several of them.
+        index = AvailabilityIndex([(1, datetime(2016, 1, 1), datetime(2016, 2, 1)),
+                                   (2, datetime(2016, 1, 5), datetime(2016, 3, 1)),
+                                   (3, datetime(2016, 1, 10), datetime(2016, 1, 20)),
+                                   (4, datetime(2016, 2, 1), datetime(2016, 4, 1)),
+                                   (5, datetime(2016, 3, 1), datetime(2016, 3, 2))],
+                                  block_size=2)
+
+        self.assertEqual(sorted(index.available(datetime(2016, 1, 15), datetime(2016, 1, 18))),
+                         [1, 2, 3])
+        self.assertEqual(sorted(index.available(datetime(2016, 2, 10), datetime(2016, 2, 20))),
+                         [2, 4])
+        self.assertEqual(index.available(datetime(2015, 12, 1), datetime(2015, 12, 2)), [])
+
     def test_categorize_products(self):
         categories = [Category.query.get(1), Category.query.get(2)]
         products = [Product.query.get(1), Product.query.get(2), Product.query.get(5)]
@@ -322,7 +775,7 @@ class SearchHelpersTestCase(TestCase):
         app.config['TESTING'] = True
         postgrespassword = os.environ['POSTGRES_PASSWORD']
         db_uri = 'postgresql://' + postgrespassword + '/test'
-        connect_to_db(app, db_uri)
+        connect_to_db(app, db_uri, 'test')
 
         db.create_all()
 
@@ -355,6 +808,21 @@ class SearchHelpersTestCase(TestCase):
         distance = calc_Haversine_distance(lat1, lng1, lat2, lng2)
         self.assertEqual(int(distance), 1794)
 
+    def test_batch_Haversine_matches_scalar(self):
+        lat1 = 37.814287
+        lng1 = -122.261123
+        lats = [36.12, 33.94, 37.814287, 40.724286, -33.86, 52.0]
+        lngs = [-86.67, -118.40, -122.261123, -74.004807, 151.21, 179.9]
+
+        distances = calc_Haversine_distances(lat1, lng1, lats, lngs)
+
+        self.assertEqual(len(distances), len(lats))
+
+        for lat2, lng2, distance in zip(lats, lngs, distances):
+            self.assertAlmostEqual(distance,
+                                   calc_Haversine_distance(lat1, lng1, lat2, lng2),
+                                   places=6)
+
     def test_get_postalcode(self):
         zipcode = PostalCode.query.get(94109)
         self.assertEqual(zipcode.latitude, 37.803893)
@@ -367,6 +835,87 @@ class SearchHelpersTestCase(TestCase):
         self.assertEqual(int(a.latitude), 46)
         self.assertEqual(int(a.longitude), -122)
 
+    def test_bulk_load_postalcodes(self):
+        num_lines = len(open('data/cityzip_fortests').readlines())
+        self.assertEqual(PostalCode.query.count(), num_lines)
+
+        # Small batches still insert every row.
+        rows = BulkInserter(PostalCode, batch_size=2)
+
+        for zipcode in range(1, 6):
+            rows.add(postalcode=zipcode, latitude=float(zipcode), longitude=-1.0)
+
+        self.assertEqual(rows.finish(), 5)
+        self.assertEqual(PostalCode.query.count(), num_lines + 5)
+        self.assertEqual(PostalCode.query.get(3).latitude, 3.0)
+
+    def test_dedupe_postalcodes(self):
+        temp_dir = tempfile.mkdtemp()
+        input_path = os.path.join(temp_dir, 'cityzip')
+        output_path = os.path.join(temp_dir, 'cityzip_nodupes')
+
+        with open(input_path, 'w') as source:
+            source.write("state,city,zipcode,lat,lng,count\n"
+                         "PR,Catano,00962,18.42906,-66.13703,11\n"
+                         "PR,Toa Baja,00962,18.443251,-66.130487,1\n"
+                         "PR,Cata+//0-o,962,0,0,1\n"
+                         "PR,Catano,962,18.4387,-66.1342,6\n"
+                         "CA,Oakland,94612,37.814287,-122.261123,1\n"
+                         "CA,Nowhere,94613,north,-122.2,1\n"
+                         "ON,Ottawa,K1A 0B1,45.4215,-75.6972,1\n"
+                         "ON,Ottawa,K1A 0B1,45.4236,-75.7009,1\n"
+                         "CA,Oakland,946120,37.814287,-122.261123,1\n")
+
+        counts = dedupe_postalcodes(input_path, output_path)
+
+        # Zipcodes postalcodes.postalcode can't hold (letters, or more than 5
+        # digits) are bad rows, not new zipcodes.
+        self.assertTrue(counts['header'])
+        self.assertEqual(counts['read'], 9)
+        self.assertEqual(counts['written'], 2)
+        self.assertEqual(counts['duplicates'], 2)
+        self.assertEqual(counts['bad'], 5)
+        self.assertEqual(counts['bad_lines'], [4, 7, 8, 9, 10])
+        # Zipcodes are written as they came in, leading zeros and all.
+        self.assertEqual(open(output_path).read(),
+                         "00962|18.42906|-66.13703\n"
+                         "94612|37.814287|-122.261123\n")
+
+    @patch.dict(os.environ, {'GOOGLE_API_KEY': ''})
+    def test_offline_geocode(self):
+        self.assertEqual(geocode('98570'), (46.581713, -122.71863))
+        self.assertEqual(geocode('02139'), (42.367661, -71.100966))
+
+        lat, lng = geocode('Oakland, CA')
+        self.assertEqual((int(lat), int(lng)), (37, -122))
+
+        self.assertEqual(geocode('00000'), None)
+
+    def test_geocode_cache(self):
+        lookups = []
+
+        def lookup(location_string):
+            lookups.append(location_string)
+            if location_string == '00000':
+                return None
+            return (37.0, -122.0)
+
+        cache = GeocodeCache(lookup)
+
+        self.assertEqual(cache.get('94612'), (37.0, -122.0))
+        self.assertEqual(cache.get('94612'), (37.0, -122.0))
+        self.assertEqual(cache.get('00000'), None)
+        self.assertEqual(cache.get('00000'), None)
+        self.assertEqual(cache.get_many(['94612', '94608', '94608']),
+                         {'94612': (37.0, -122.0), '94608': (37.0, -122.0)})
+
+        self.assertEqual(lookups, ['94612', '00000', '94608'])
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['negative_hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+
     def test_search_radius(self):
         searchcenter = '94607'
         postalcodes = [('94608',), ('94102',), ('94040',), ('95376',), ('95451',),
@@ -382,6 +931,240 @@ class SearchHelpersTestCase(TestCase):
         self.assertEqual(sorted(within200), sorted(['94608', '94102', '94040',
                                                     '95376', '95451']))
 
+    def test_postalcode_index(self):
+        postalcode_index = get_postalcode_index()
+        self.assertEqual(postalcode_index.get('94109'), (37.803893, -122.42364))
+
+        make_postalcode('98570')
+        self.assertIn(98570, postalcode_index)
+
+        lat, lng = postalcode_index.get(94612)
+        zipcodes, lats, lngs = postalcode_index.candidates(lat, lng, 20)
+        self.assertIn(94608, zipcodes)
+        self.assertNotIn(10013, zipcodes)
+
+    def test_search_center_added_by_another_process(self):
+        # Another worker added 94612, so it's in the database but not in this
+        # process's index. It shouldn't be geocoded and inserted again.
+        postalcode_index = get_postalcode_index()
+        location = postalcode_index.get(94612)
+        postalcode_index.remove(94612)
+
+        with patch('search_helpers.make_postalcode') as mock_make_postalcode:
+            self.assertEqual(get_search_center('94612'), location)
+            self.assertFalse(mock_make_postalcode.called)
+
+        self.assertIn(94612, postalcode_index)
+
+    def test_search_radius_strategies_match(self):
+        postalcodes = [('94608',), ('94102',), ('94040',), ('95376',), ('95451',),
+                       ('92277',), ('10013',), ('02139',)]
+
+        for radius in [1, 20, 60, 200, 3000]:
+            expected = sorted(search_radius('94612', postalcodes, radius,
+                                            strategy='brute_force'))
+
+            self.assertEqual(sorted(search_radius('94612', postalcodes, radius,
+                                                  strategy='bbox')), expected)
+            self.assertEqual(sorted(search_radius('94612', postalcodes, radius,
+                                                  strategy='cached')), expected)
+
+    def test_search_products(self):
+        start_date = convert_string_to_datetime('2015-12-01')
+        end_date = convert_string_to_datetime('2015-12-02')
+
+        inventory, next_cursors = search_products('94612', 20, 2, start_date,
+                                                  end_date, -1, -1)
+
+        self.assertEqual(sorted(inventory.keys()), ['Sleeping Bags', 'Sleeping Pads', 'Tents'])
+        self.assertEqual([row.prod_id for row in inventory['Tents']], [1, 3])
+        self.assertEqual([row.prod_id for row in inventory['Sleeping Pads']], [9, 12])
+        self.assertEqual(inventory['Tents'][0].brand_name, 'REI')
+        self.assertEqual(inventory['Tents'][0].city, 'Oakland')
+        self.assertEqual(next_cursors['Tents'], None)
+
+        inventory, next_cursors = search_products('94612', 20, 2, start_date,
+                                                  end_date, -1, 1)
+        self.assertEqual([row.prod_id for row in inventory['Sleeping Bags']], [5])
+        self.assertEqual(inventory['Sleeping Pads'], [])
+
+        inventory, next_cursors = search_products('94612', 20, 1, start_date,
+                                                  end_date, 1, -1)
+        self.assertEqual(inventory, {'Tents': []})
+
+    def test_search_products_keywords(self):
+        start_date = convert_string_to_datetime('2015-12-01')
+        end_date = convert_string_to_datetime('2015-12-02')
+
+        # The Sierra Designs Flash 3 tent and the REI Flash sleeping bag.
+        inventory, next_cursors = search_products('94612', 20, 2, start_date,
+                                                  end_date, -1, -1,
+                                                  keywords='flash')
+        self.assertEqual([row.prod_id for row in inventory['Tents']], [3])
+        self.assertEqual([row.prod_id for row in inventory['Sleeping Bags']], [5])
+        self.assertEqual(inventory['Sleeping Pads'], [])
+
+        # Brand names are searchable too.
+        inventory, next_cursors = search_products('94612', 20, 2, start_date,
+                                                  end_date, 1, -1,
+                                                  keywords='sierra designs')
+        self.assertEqual([row.prod_id for row in inventory['Tents']], [3])
+
+        category_counts, brand_counts = count_search_facets('94612', 20, 2, start_date,
+                                                            end_date, -1, -1,
+                                                            keywords='flash')
+        self.assertEqual(category_counts, {1: 1, 2: 1})
+
+    def test_search_products_pages(self):
+        start_date = convert_string_to_datetime('2015-12-01')
+        end_date = convert_string_to_datetime('2015-12-02')
+
+        inventory, next_cursors = search_products('94612', 20, 2, start_date,
+                                                  end_date, 1, -1, page_size=1)
+        self.assertEqual([row.prod_id for row in inventory['Tents']], [1])
+
+        cursor = decode_cursor(next_cursors['Tents'])
+        inventory, next_cursors = search_products('94612', 20, 2, start_date,
+                                                  end_date, 1, -1,
+                                                  cursors={1: cursor}, page_size=1)
+        self.assertEqual([row.prod_id for row in inventory['Tents']], [3])
+        self.assertEqual(next_cursors['Tents'], None)
+
+    def test_count_search_facets(self):
+        start_date = convert_string_to_datetime('2015-12-01')
+        end_date = convert_string_to_datetime('2015-12-02')
+
+        category_counts, brand_counts = count_search_facets('94612', 20, 2, start_date,
+                                                            end_date, -1, -1)
+        # Franken's tents (1, 3), sleeping bag (5), and sleeping pads (9, 12).
+        self.assertEqual(category_counts, {1: 2, 2: 1, 3: 2})
+        self.assertEqual(brand_counts, {1: 2, 2: 1, 5: 1, 6: 1})
+
+        category_counts, brand_counts = count_search_facets('94612', 20, 2, start_date,
+                                                            end_date, 1, 1)
+        self.assertEqual(category_counts, {1: 1, 2: 1})
+        self.assertEqual(brand_counts, {1: 1, 2: 1})
+
+    def test_cached_search_products(self):
+        start_date = convert_string_to_datetime('2015-12-01')
+        end_date = convert_string_to_datetime('2015-12-02')
+        search_result_cache.clear()
+        # The cache is shared by the whole test run, so count hits from here.
+        hits = search_result_cache.stats()['hits']
+
+        inventory, next_cursors = cached_search_products('94612', 20, 2, start_date,
+                                                         end_date, 1, -1)
+        self.assertEqual([row.prod_id for row in inventory['Tents']], [1, 3])
+
+        # Same search by the owner of both tents is a cache hit with the
+        # owner's own tents taken out.
+        inventory, next_cursors = cached_search_products('94612', 20, 1, start_date,
+                                                         end_date, 1, -1)
+        self.assertEqual(inventory['Tents'], [])
+        self.assertEqual(search_result_cache.stats()['hits'], hits + 1)
+
+        # A cache hit after the saved distances were thrown away (e.g. by a
+        # new postal code nearby) fills them back in instead of coming back
+        # empty.
+        invalidate_zip_distances(94612)
+        inventory, next_cursors = cached_search_products('94612', 20, 2, start_date,
+                                                         end_date, 1, -1)
+        self.assertEqual([row.prod_id for row in inventory['Tents']], [1, 3])
+        self.assertEqual(search_result_cache.stats()['hits'], hits + 2)
+
+        # A cache hit leaves out a tent that was booked or taken down without
+        # invalidating the cache (e.g. by another process).
+        db.session.add(History(prod_id=1, renter_user_id=2, start_date=start_date,
+                               end_date=end_date, total_cost=20))
+        Product.query.get(3).available = False
+        db.session.commit()
+
+        inventory, next_cursors = cached_search_products('94612', 20, 2, start_date,
+                                                         end_date, 1, -1)
+        self.assertEqual(inventory['Tents'], [])
+        self.assertEqual(search_result_cache.stats()['hits'], hits + 3)
+        self.assertEqual(len(search_result_cache), 1)
+
+        search_result_cache.invalidate_products([3])
+        self.assertEqual(len(search_result_cache), 0)
+
+    def test_search_result_cache_eviction(self):
+        cache = SearchResultCache(max_size=2)
+        cache.put('a', 1, [1], 37.8, -122.3, 10)
+        cache.put('b', 2, [2], 40.7, -74.0, 10)
+        self.assertEqual(cache.get('a'), 1)
+
+        cache.put('c', 3, [3], 37.8, -122.3, 10)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        # Only the search around Oakland covers this spot.
+        cache.invalidate_location(37.814287, -122.261123)
+        self.assertEqual(len(cache), 0)
+
+    def test_bounding_boxes(self):
+        # Oakland: one box, wider in longitude than in latitude.
+        boxes = calc_bounding_boxes(37.814287, -122.261123, 10)
+        self.assertEqual(len(boxes), 1)
+        min_lat, max_lat, min_lng, max_lng = boxes[0]
+        self.assertTrue(max_lng - min_lng > max_lat - min_lat)
+
+        # Western Aleutians: split at the antimeridian.
+        boxes = calc_bounding_boxes(52.0, 179.9, 20)
+        self.assertEqual(len(boxes), 2)
+        self.assertEqual(boxes[0][3], 180)
+        self.assertEqual(boxes[1][2], -180)
+
+        # Close enough to the pole that every longitude is in range.
+        boxes = calc_bounding_boxes(89.5, 10, 100)
+        self.assertEqual(boxes, [(89.5 - 100 / 69.0, 90, -180, 180)])
+
+    def test_zip_distances_cache(self):
+        nearby = get_nearby_postalcodes(94612, 20)
+        self.assertEqual(sorted(nearby.keys()), [94102, 94109, 94608, 94612])
+        self.assertEqual(ZipDistanceCenter.query.get(94612).max_miles, 100)
+
+        # A bigger radius within the saved radius reuses the saved rows.
+        nearby = get_nearby_postalcodes(94612, 60)
+        self.assertIn(95376, nearby)
+        self.assertEqual(ZipDistanceCenter.query.get(94612).max_miles, 100)
+
+        invalidate_zip_distances(94608)
+        self.assertEqual(ZipDistanceCenter.query.get(94612), None)
+        self.assertEqual(ZipDistance.query.filter(ZipDistance.center == 94612).count(), 0)
+
+        # Postal codes this process's index doesn't have yet (added by another
+        # process) are still saved, since they come from the database.
+        db.session.add(PostalCode(postalcode=94613, latitude=37.78, longitude=-122.18))
+        db.session.commit()
+        self.assertNotIn(94613, get_postalcode_index())
+        self.assertIn(94613, get_nearby_postalcodes(94612, 20))
+
+    def test_concurrent_zip_distances(self):
+        errors = []
+
+        def search_from(center):
+            with app.app_context():
+                try:
+                    ensure_zip_distances(center, 20)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=search_from, args=(94612,))
+                   for _ in range(5)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(ZipDistanceCenter.query.get(94612).max_miles, 100)
+        self.assertEqual(ZipDistance.query.filter(ZipDistance.center == 94612,
+                                                  ZipDistance.neighbor == 94612).count(), 1)
+
     # http://www.robotswillkillusall.org/posts/how-to-mock-datetime-in-python/
     # https://pypi.python.org/pypi/mock
     @patch('search_helpers.datetime')
@@ -0,0 +1,221 @@
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+import threading
+import time
+import os
+
+"""
+    Database engine settings for each environment, and connection pool
+    metrics.
+
+    HAPPYCAMPER_ENV picks a profile (dev, test, or prod; prod if it isn't
+    set, so a server nobody configured doesn't log every query). Run
+    locally with HAPPYCAMPER_ENV=dev to get the dev settings. Any setting
+    can be overridden with an environment variable named DB_ plus the
+    setting in capitals, e.g. DB_POOL_SIZE=20.
+
+        echo: print every SQL statement (dev only, it's slow and noisy)
+        pool_size: connections each process keeps open
+        max_overflow: extra connections allowed when the pool is busy
+        pool_timeout: seconds to wait for a connection before giving up
+        pool_recycle: seconds before a connection is replaced, so we don't
+                      use ones the server or a proxy has closed
+        pre_ping: check connections with SELECT 1 when they're checked out
+                  of the pool and reconnect if they're dead
+        statement_timeout_ms: Postgres cancels statements that run longer
+                              than this (0 means no limit)
+
+    Each gunicorn worker has its own pool, so Postgres needs
+    workers * (pool_size + max_overflow) connections at most.
+
+    MeteredQueuePool keeps track of how long checkouts wait for a connection
+    and how many time out, so we can tell when the pool is too small. See
+    /db-pool-stats in server.py.
+
+"""
+
+DB_PROFILES = {'dev': {'echo': True,
+                       'pool_size': 5,
+                       'max_overflow': 5,
+                       'pool_timeout': 10,
+                       'pool_recycle': 3600,
+                       'pre_ping': False,
+                       'statement_timeout_ms': 0,
+                       },
+               'test': {'echo': False,
+                        'pool_size': 5,
+                        'max_overflow': 5,
+                        'pool_timeout': 10,
+                        'pool_recycle': 3600,
+                        'pre_ping': False,
+                        'statement_timeout_ms': 30000,
+                        },
+               'prod': {'echo': False,
+                        'pool_size': 10,
+                        'max_overflow': 5,
+                        'pool_timeout': 5,
+                        'pool_recycle': 1800,
+                        'pre_ping': True,
+                        'statement_timeout_ms': 5000,
+                        },
+               }
+
+
+def get_db_profile(name=None):
+    """ Returns a dictionary of engine settings for a profile name (default:
+        HAPPYCAMPER_ENV, or prod), with any DB_* environment overrides.
+        Raises ValueError for an unknown profile name.
+    """
+
+    name = name or os.environ.get('HAPPYCAMPER_ENV', 'prod')
+
+    if name not in DB_PROFILES:
+        raise ValueError("Unknown database profile %r. Use one of %s." % (
+            name, ', '.join(sorted(DB_PROFILES))))
+
+    profile = dict(DB_PROFILES[name])
+
+    for setting, default in profile.items():
+        override = os.environ.get('DB_' + setting.upper())
+
+        if override is None:
+            continue
+
+        if isinstance(default, bool):
+            profile[setting] = override.lower() in ('1', 'true', 'yes')
+        else:
+            profile[setting] = int(override)
+
+    return profile
+
+
+class PoolMetrics(object):
+    """ Counts connection pool checkouts, how long they waited, and how many
+        timed out.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Sets every counter back to zero."""
+
+        with self.lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def record_checkout(self, wait_seconds, timed_out=False):
+        """Counts one checkout that waited wait_seconds."""
+
+        with self.lock:
+            self.checkouts += 1
+            self.wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+            if timed_out:
+                self.timeouts += 1
+
+    def stats(self, pool=None):
+        """ Returns a dictionary of checkout counters, plus the pool's current
+            size and connections in use if a pool is given.
+        """
+
+        with self.lock:
+            if self.checkouts:
+                avg_wait_ms = self.wait_seconds / self.checkouts * 1000
+            else:
+                avg_wait_ms = 0.0
+
+            stats = {'checkouts': self.checkouts,
+                     'timeouts': self.timeouts,
+                     'avg_wait_ms': avg_wait_ms,
+                     'max_wait_ms': self.max_wait_seconds * 1000,
+                     }
+
+        if isinstance(pool, QueuePool):
+            stats['pool_size'] = pool.size()
+            stats['checked_out'] = pool.checkedout()
+            stats['overflow'] = pool.overflow()
+
+        return stats
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    """ QueuePool that records how long each checkout takes in pool_metrics.
+        The time includes opening a new connection when the pool makes one.
+    """
+
+    def _do_get(self):
+        start = time.time()
+
+        try:
+            connection = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            pool_metrics.record_checkout(time.time() - start, timed_out=True)
+            raise
+
+        pool_metrics.record_checkout(time.time() - start)
+
+        return connection
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """ Checks a connection when it's checked out of the pool. If it's dead,
+        the pool throws it away and tries another one.
+    """
+
+    cursor = dbapi_connection.cursor()
+
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class ConfiguredSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with the extra engine settings from a profile:
+        the metered pool and the Postgres statement timeout.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+        options['poolclass'] = MeteredQueuePool
+
+        if app.config.get('SQLALCHEMY_MAX_OVERFLOW') is not None:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+        statement_timeout_ms = app.config.get('STATEMENT_TIMEOUT_MS')
+
+        if statement_timeout_ms and info.drivername.startswith('postgresql'):
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = '-c statement_timeout=%d' % statement_timeout_ms
+
+
+def configure_engine(app, profile):
+    """ Puts a profile's settings in app.config, where Flask-SQLAlchemy and
+        ConfiguredSQLAlchemy look for them when they make the engine.
+    """
+
+    app.config['SQLALCHEMY_ECHO'] = profile['echo']
+    app.config['SQLALCHEMY_POOL_SIZE'] = profile['pool_size']
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = profile['max_overflow']
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = profile['pool_timeout']
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = profile['pool_recycle']
+    app.config['STATEMENT_TIMEOUT_MS'] = profile['statement_timeout_ms']
+
+
+def install_pre_ping(engine):
+    """Pings connections on checkout from engine's pool (only once)."""
+
+    if not event.contains(engine, 'checkout', ping_connection):
+        event.listen(engine, 'checkout', ping_connection)
@@ -0,0 +1,334 @@
+from model import PostalCode, ZipDistance, ZipDistanceCenter, db
+from sqlalchemy import and_, or_
+from postalcode_index import get_postalcode_index
+from array import array
+import math
+
+"""
+    Distance helper functions shared by search_helpers.py and
+    make_update_helpers.py.
+
+    Besides the Haversine math, this keeps the zip_distances table up to
+    date. The first time a postal code is used as a search center, we save
+    the distances to every postal code within DEFAULT_CACHED_RADIUS miles (or
+    the search radius, if that's bigger). Later searches from that center at
+    any radius up to the saved radius are one range scan on
+    (center, miles).
+
+"""
+
+# One degree of latitude is about 69 miles everywhere. A degree of longitude
+# is 69 miles times the cosine of the latitude.
+MILES_PER_DEGREE = 69.0
+
+# Save at least this many miles' worth of neighbors so small changes to the
+# search radius don't have to recalculate anything.
+DEFAULT_CACHED_RADIUS = 100
+
+
+def calc_Haversine_distance(lat1, lng1, lat2, lng2):
+    """
+        Uses the Haversine formual to calculate the distance in miles between two
+        pairs of lat and longs.
+
+    """
+
+    radius_of_earth_miles = 3960
+    # radius_of_earth_km = 6373
+
+    convert_to_radians = math.pi / 180
+
+    d_lat = convert_to_radians * (lat2 - lat1)
+    d_lon = convert_to_radians * (lng2 - lng1)
+    lat1_radians = convert_to_radians * lat1
+    lat2_radians = convert_to_radians * lat2
+
+    a = math.sin(d_lat / 2)**2 + (math.cos(lat1_radians) * math.cos(lat2_radians) * math.sin(d_lon / 2)**2)
+    c = 2 * math.asin(math.sqrt(a))
+
+    d = radius_of_earth_miles * c
+
+    return d
+
+
+def calc_Haversine_distances(lat1, lng1, lats, lngs):
+    """
+        Batch version of calc_Haversine_distance above. Calculates the
+        distance in miles from one search center to many points in one call.
+
+        Takes in the latitude and longitude of the center and two parallel
+        sequences (lists or array('d')s) of latitudes and longitudes, and
+        returns an array('d') of distances in the same order.
+
+        The terms that only depend on the center are worked out once, and the
+        loop itself only touches local names, which is a lot cheaper than
+        calling the scalar function once per point.
+
+    """
+
+    radius_of_earth_miles = 3960
+    convert_to_radians = math.pi / 180
+
+    lat1_radians = convert_to_radians * lat1
+    lng1_radians = convert_to_radians * lng1
+    cos_lat1 = math.cos(lat1_radians)
+
+    sin = math.sin
+    cos = math.cos
+    asin = math.asin
+    sqrt = math.sqrt
+
+    distances = array('d')
+    append = distances.append
+
+    for lat2, lng2 in zip(lats, lngs):
+        lat2_radians = convert_to_radians * lat2
+        sin_d_lat = sin((lat2_radians - lat1_radians) / 2)
+        sin_d_lon = sin((convert_to_radians * lng2 - lng1_radians) / 2)
+
+        a = sin_d_lat * sin_d_lat + cos_lat1 * cos(lat2_radians) * sin_d_lon * sin_d_lon
+
+        # Rounding can push it a hair over 1 for antipodal points.
+        append(2 * radius_of_earth_miles * asin(sqrt(min(a, 1.0))))
+
+    return distances
+
+
+def calc_bounding_boxes(lat, lng, radius):
+    """ Works out the latitude/longitude box(es) that contain every point
+        within a radius of a search center.
+
+        Takes in latitude and longitude of the center and radius in miles, and
+        returns a list of (min_lat, max_lat, min_lng, max_lng) tuples. This is
+        usually one box, but a box that crosses the antimeridian (e.g. the
+        western Aleutians) is split into one box on each side. If the circle
+        reaches a pole, or is wide enough that the longitude span would wrap
+        all the way around, the box covers every longitude.
+
+    """
+
+    lat_span = radius / MILES_PER_DEGREE
+    min_lat = lat - lat_span
+    max_lat = lat + lat_span
+
+    if min_lat <= -90 or max_lat >= 90:
+        return [(max(min_lat, -90), min(max_lat, 90), -180, 180)]
+
+    # The box has to be widest at whichever edge is closest to a pole.
+    cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    lng_span = radius / (MILES_PER_DEGREE * cos_lat)
+
+    if lng_span >= 180:
+        return [(min_lat, max_lat, -180, 180)]
+
+    min_lng = lng - lng_span
+    max_lng = lng + lng_span
+
+    if min_lng < -180:
+        return [(min_lat, max_lat, min_lng + 360, 180),
+                (min_lat, max_lat, -180, max_lng)]
+    elif max_lng > 180:
+        return [(min_lat, max_lat, min_lng, 180),
+                (min_lat, max_lat, -180, max_lng - 360)]
+    else:
+        return [(min_lat, max_lat, min_lng, max_lng)]
+
+
+def get_postalcodes_in_bounding_box(lat, lng, radius):
+    """ Finds postal codes within a radius of a search center by first
+        narrowing down the PostalCodes table to a lat/long bounding box with
+        the (latitude, longitude) index, then checking exact distances.
+
+        Takes in latitude and longitude of the center and radius in miles, and
+        returns a dictionary of nearby postal codes (integers) to distances in
+        miles.
+
+    """
+
+    boxes = []
+
+    for min_lat, max_lat, min_lng, max_lng in calc_bounding_boxes(lat, lng, radius):
+        boxes.append(and_(PostalCode.latitude.between(min_lat, max_lat),
+                          PostalCode.longitude.between(min_lng, max_lng)))
+
+    query = db.session.query(PostalCode.postalcode, PostalCode.latitude,
+                             PostalCode.longitude).filter(or_(*boxes))
+
+    zipcodes = []
+    lats = array('d')
+    lngs = array('d')
+
+    for zipcode, lat2, lng2 in query:
+        zipcodes.append(zipcode)
+        lats.append(lat2)
+        lngs.append(lng2)
+
+    distances = calc_Haversine_distances(lat, lng, lats, lngs)
+
+    nearby_postalcodes = {}
+
+    for zipcode, distance in zip(zipcodes, distances):
+        if distance <= radius:
+            nearby_postalcodes[zipcode] = distance
+
+    return nearby_postalcodes
+
+
+def cache_zip_distances(center, radius):
+    """ Saves distances from a search center to all postal codes within a
+        radius into the zip_distances table, replacing whatever was saved for
+        that center before, unless it already has them out to radius.
+
+        Takes in search center as an integer and radius in miles. Assumes the
+        center is already in the PostalCodes table.
+
+        The center's PostalCodes row is locked until the commit, so two
+        processes filling the same center take turns, and the second one
+        finds the first one's distances. Neighbors come from the PostalCodes
+        table rather than this process's postal code index, which may not have
+        postal codes other processes added.
+
+    """
+
+    location = PostalCode.query.with_for_update().populate_existing().get(center)
+
+    cached_center = ZipDistanceCenter.query.populate_existing().get(center)
+
+    if cached_center and cached_center.max_miles >= radius:
+        # Another process filled it in while we waited for the lock.
+        db.session.commit()
+        return
+
+    nearby_postalcodes = get_postalcodes_in_bounding_box(location.latitude,
+                                                         location.longitude,
+                                                         radius)
+
+    rows = [{'center': center, 'neighbor': zipcode, 'miles': distance}
+            for zipcode, distance in nearby_postalcodes.iteritems()]
+
+    ZipDistance.query.filter(ZipDistance.center == center).delete()
+
+    # Use a single executemany instead of making hundreds of ORM objects.
+    if rows:
+        db.session.execute(ZipDistance.__table__.insert(), rows)
+
+    if cached_center:
+        cached_center.max_miles = radius
+    else:
+        db.session.add(ZipDistanceCenter(center=center, max_miles=radius))
+
+    db.session.commit()
+
+
+def ensure_zip_distances(center, radius):
+    """ Makes sure the zip_distances table has every postal code within a
+        radius of a search center, filling it in if this center hasn't been
+        searched this far out before.
+
+        Takes in search center as an integer and radius in miles.
+
+    """
+
+    cached_center = ZipDistanceCenter.query.get(center)
+
+    if not cached_center or cached_center.max_miles < radius:
+        cache_zip_distances(center, max(radius, DEFAULT_CACHED_RADIUS))
+
+
+def get_nearby_postalcodes(center, radius):
+    """ Finds postal codes within a radius of a search center using the
+        zip_distances table (see ensure_zip_distances).
+
+        Takes in search center as an integer and radius in miles, and returns
+        a dictionary of nearby postal codes (integers) to distances in miles.
+
+    """
+
+    ensure_zip_distances(center, radius)
+
+    query = db.session.query(ZipDistance.neighbor, ZipDistance.miles).filter(
+        ZipDistance.center == center, ZipDistance.miles <= radius)
+
+    return dict(query.all())
+
+
+def invalidate_zip_distances(postalcode):
+    """ Throws away saved distances for any search center whose saved radius
+        reaches a new or moved postal code, so the next search from those
+        centers recalculates and picks it up.
+
+        Takes in postal code as an integer or string. Called by
+        make_postalcode after the postal code index is refreshed.
+
+    """
+
+    invalidate_zip_distances_many([postalcode])
+    db.session.commit()
+
+
+def invalidate_zip_distances_many(postalcodes, locations=None):
+    """ Same as invalidate_zip_distances, but for many postal codes with one
+        pass over the saved centers. Doesn't commit, so it can go in the same
+        transaction as the change (e.g. a seed.py sync, which has to do this
+        before deleting postal codes that saved distances point to).
+
+        Takes in a list of postal codes as integers or strings, and a
+        dictionary of their new locations (postal code to (latitude,
+        longitude)), which defaults to the postal code index. Postal codes
+        with no location (e.g. deleted ones) only throw away the centers that
+        have a saved distance to them.
+
+    """
+
+    postalcodes = set(int(postalcode) for postalcode in postalcodes)
+
+    if not postalcodes:
+        return
+
+    postalcode_index = get_postalcode_index()
+
+    if locations is None:
+        locations = dict((postalcode, postalcode_index.get(postalcode))
+                         for postalcode in postalcodes)
+
+    lats = array('d')
+    lngs = array('d')
+
+    for postalcode in postalcodes:
+        location = locations.get(postalcode)
+
+        if location:
+            lats.append(location[0])
+            lngs.append(location[1])
+
+    stale_centers = set(postalcodes)
+
+    # Centers that reached where a postal code used to be.
+    query = db.session.query(ZipDistance.center).filter(
+        ZipDistance.neighbor.in_(list(postalcodes))).distinct()
+    stale_centers.update(center for (center,) in query)
+
+    # Centers that reach where a postal code is now.
+    if lats:
+        for cached_center in ZipDistanceCenter.query.all():
+            if cached_center.center in stale_centers:
+                continue
+
+            center_location = postalcode_index.get(cached_center.center)
+
+            if not center_location:
+                stale_centers.add(cached_center.center)
+                continue
+
+            distances = calc_Haversine_distances(center_location[0],
+                                                 center_location[1], lats, lngs)
+
+            if min(distances) <= cached_center.max_miles:
+                stale_centers.add(cached_center.center)
+
+    stale_centers = list(stale_centers)
+
+    ZipDistance.query.filter(ZipDistance.center.in_(stale_centers)).delete(
+        synchronize_session=False)
+    ZipDistanceCenter.query.filter(ZipDistanceCenter.center.in_(stale_centers)).delete(
+        synchronize_session=False)
@@ -0,0 +1,348 @@
+from geolocation.google_maps import GoogleMaps
+from array import array
+import bisect
+import os
+import threading
+import time
+
+"""
+    Offline geocoder backed by the opengeocode cityzip dataset in data/cityzip
+    (source: http://www.opengeocode.org/download.php#cityzip).
+
+    Each row of the file is state,city,zipcode,latitude,longitude followed by
+    a column we don't use. The file is loaded once per process into parallel
+    arrays sorted by zipcode, so a zipcode lookup is a binary search and the
+    whole table is a few hundred kilobytes. The GoogleMaps API is only used
+    as a fallback for locations that aren't in the file, and only if
+    GOOGLE_API_KEY is set.
+
+    Lookups go through a GeocodeCache that remembers found locations for a
+    day and locations that couldn't be found for an hour, so a bad zipcode
+    doesn't hit GoogleMaps on every search.
+
+"""
+
+CITYZIP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data', 'cityzip')
+
+# How long to remember locations that were found and not found, in seconds.
+GEOCODE_TTL = 24 * 60 * 60
+GEOCODE_NEGATIVE_TTL = 60 * 60
+
+# Most cached locations to keep before throwing some away.
+GEOCODE_CACHE_SIZE = 50000
+
+
+class CityZipTable(object):
+    """ Latitudes and longitudes of zipcodes and "city, state" names. """
+
+    def __init__(self):
+        self.zipcodes = array('i')
+        self.lats = array('d')
+        self.lngs = array('d')
+        # Maps (city, state), both lower case, to (latitude, longitude).
+        self.cities = {}
+
+    def __len__(self):
+        return len(self.zipcodes)
+
+    def load(self, file_path):
+        """ Loads a cityzip file.
+
+            Some zipcodes cover more than one city, in which case the first
+            row for the zipcode wins. A city's location is the average of the
+            locations of all its rows.
+
+        """
+
+        rows = []
+        city_totals = {}
+
+        for row in open(file_path):
+            row = row.strip()
+
+            if not row:
+                continue
+
+            state, city, zipcode, lat, lng = row.split(',')[:5]
+            lat = float(lat)
+            lng = float(lng)
+
+            rows.append((int(zipcode), lat, lng))
+
+            totals = city_totals.setdefault((city.lower(), state.lower()), [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += lat
+            totals[2] += lng
+
+        # Python's sort is stable, so rows for the same zipcode stay in file
+        # order.
+        rows.sort(key=lambda row: row[0])
+
+        for zipcode, lat, lng in rows:
+            if not self.zipcodes or self.zipcodes[-1] != zipcode:
+                self.zipcodes.append(zipcode)
+                self.lats.append(lat)
+                self.lngs.append(lng)
+
+        for city_state, (count, sum_lats, sum_lngs) in city_totals.iteritems():
+            self.cities[city_state] = (sum_lats / count, sum_lngs / count)
+
+    def find_postalcode(self, postalcode):
+        """ Takes in postal code as an integer or string (e.g. '02139') and
+            returns a tuple of (latitude, longitude), or None if not found.
+        """
+
+        postalcode = int(postalcode)
+        idx = bisect.bisect_left(self.zipcodes, postalcode)
+
+        if idx < len(self.zipcodes) and self.zipcodes[idx] == postalcode:
+            return (self.lats[idx], self.lngs[idx])
+
+        return None
+
+    def find_city(self, city, state):
+        """ Takes in city name and state abbreviation and returns a tuple of
+            (latitude, longitude), or None if not found.
+        """
+
+        return self.cities.get((city.strip().lower(), state.strip().lower()))
+
+
+_cityzip_table = None
+
+
+def get_cityzip_table():
+    """Returns the process-wide cityzip table, loading it on first use."""
+
+    global _cityzip_table
+
+    if _cityzip_table is None:
+        table = CityZipTable()
+        table.load(CITYZIP_FILE)
+        _cityzip_table = table
+
+    return _cityzip_table
+
+
+def geocode_with_google(location_string):
+    """ Looks up a location with the GoogleMaps API.
+
+        Returns a tuple of (latitude, longitude), or None if there is no API
+        key, the location isn't found, or GoogleMaps can't be reached.
+
+    """
+
+    api_key = os.environ.get('GOOGLE_API_KEY')
+
+    if not api_key:
+        return None
+
+    try:
+        google_maps = GoogleMaps(api_key=api_key)
+        location = google_maps.search(location=location_string).first()
+    except Exception as error:
+        print "\n\n Google Maps API lookup for %r failed: %r \n\n" % (location_string, error)
+        return None
+
+    print "\n\n\n\n Google Maps API: location is %r \n\n" % location
+
+    if not location:
+        return None
+
+    return (location.lat, location.lng)
+
+
+def geocode(location_string):
+    """ Finds the latitude and longitude of a location.
+
+        Takes in a zipcode (e.g. '94612' or '02139') or a "city, state" string
+        (e.g. 'Oakland, CA'), and returns a tuple of (latitude, longitude), or
+        None if the location can't be found. Checks the local cityzip table
+        first and only calls GoogleMaps if it isn't there.
+
+    """
+
+    location_string = location_string.strip()
+    table = get_cityzip_table()
+
+    if location_string.isdigit():
+        location = table.find_postalcode(location_string)
+    elif ',' in location_string:
+        city, state = location_string.rsplit(',', 1)
+        location = table.find_city(city, state)
+    else:
+        location = None
+
+    if location is None:
+        location = geocode_with_google(location_string)
+
+    return location
+
+
+class GeocodeCache(object):
+    """ Caches results of a geocoding function.
+
+        Found locations are kept for ttl seconds and not found (None) results
+        for negative_ttl seconds. If several threads ask for the same location
+        at once, only one of them calls the geocoding function and the rest
+        wait for its answer.
+
+    """
+
+    def __init__(self, lookup, ttl=GEOCODE_TTL, negative_ttl=GEOCODE_NEGATIVE_TTL,
+                 max_size=GEOCODE_CACHE_SIZE):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+        # Maps location string to (location, time it expires).
+        self.entries = {}
+        # Maps location string to a threading.Event for lookups in progress.
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.lookup_seconds = 0.0
+
+    def _cached(self, key, now):
+        """ Returns (True, location) if key has an unexpired entry, otherwise
+            (False, None). Must be called with the lock held.
+        """
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return False, None
+
+        location, expires = entry
+
+        if expires <= now:
+            del self.entries[key]
+            return False, None
+
+        return True, location
+
+    def _store(self, key, location, now):
+        """Saves a result. Must be called with the lock held."""
+
+        if len(self.entries) >= self.max_size:
+            for old_key, (old_location, expires) in self.entries.items():
+                if expires <= now:
+                    del self.entries[old_key]
+
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem()
+
+        if location is None:
+            self.entries[key] = (None, now + self.negative_ttl)
+        else:
+            self.entries[key] = (location, now + self.ttl)
+
+    def get(self, location_string):
+        """ Returns the (latitude, longitude) of a location, or None if it
+            can't be found, using a cached result if there is one.
+        """
+
+        key = location_string.strip().lower()
+
+        while True:
+            with self.lock:
+                found, location = self._cached(key, time.time())
+
+                if found:
+                    if location is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return location
+
+                event = self.in_flight.get(key)
+
+                if event is None:
+                    event = threading.Event()
+                    self.in_flight[key] = event
+                    self.misses += 1
+                    break
+
+                self.waits += 1
+
+            # Someone else is already looking this up. Wait for them, then
+            # check the cache again.
+            event.wait()
+
+        start = time.time()
+
+        try:
+            location = self.lookup(location_string)
+        except Exception:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+            raise
+
+        now = time.time()
+
+        with self.lock:
+            self.lookup_seconds += now - start
+            self._store(key, location, now)
+            del self.in_flight[key]
+
+        event.set()
+
+        return location
+
+    def get_many(self, location_strings):
+        """ Looks up many locations at once.
+
+            Takes in a list of location strings and returns a dictionary of
+            location string to (latitude, longitude) or None. Each distinct
+            location is only looked up once.
+
+        """
+
+        locations = {}
+
+        for location_string in location_strings:
+            if location_string not in locations:
+                locations[location_string] = self.get(location_string)
+
+        return locations
+
+    def clear(self):
+        """Forgets every cached result."""
+
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """ Returns a dictionary of cache counters: found and not found hits,
+            misses (calls to the geocoding function), lookups that waited on
+            another thread, and average seconds per call.
+        """
+
+        with self.lock:
+            if self.misses:
+                avg_lookup_seconds = self.lookup_seconds / self.misses
+            else:
+                avg_lookup_seconds = 0.0
+
+            return {'hits': self.hits,
+                    'negative_hits': self.negative_hits,
+                    'misses': self.misses,
+                    'waits': self.waits,
+                    'size': len(self.entries),
+                    'avg_lookup_seconds': avg_lookup_seconds}
+
+
+geocode_cache = GeocodeCache(geocode)
+
+
+def cached_geocode(location_string):
+    """Same as geocode, but uses the process-wide geocode_cache."""
+
+    return geocode_cache.get(location_string)
@@ -1,27 +1,187 @@
-def get_rid_of_duplicates(file_path):
-    dict_of_zips = {}
-    for row in open(file_path):
-        row.strip()
-        temp = row.split(',')
-        zipcode = int(temp[2])
-        lat = temp[3]
-        longide = temp[4]
-        dict_of_zips[zipcode] = (lat, longide)
+import os
+import sys
 
-    return dict_of_zips
+"""
+    Turns the opengeocode cityzip file (data/cityzip) into the
+    zipcode|latitude|longitude file seed.load_postalcodes loads
+    (data/cityzip_nodupes), one zipcode per row.
 
-def write_to_new_file(file_path, zips_to_add):
-    target = open(file_path, 'w')
-    target.truncate()
+        python getridofduplicates.py [input file] [output file]
 
-    for zipcode in zips_to_add:
-        line = str(zipcode) + '|' + zips_to_add[zipcode][0] + '|' + zips_to_add[zipcode][1]
-        target.write(line)
-        target.write("\n")
+    Rows are read, checked, and written one at a time, so it works on files
+    of any size. The first row for a zipcode wins, same as the offline
+    geocoder in geocoder.py.
 
+    Zipcodes are written exactly as they are in the input, so 00601 stays
+    00601. Zipcodes already seen are found with a bitmap with one bit for
+    every possible 5 digit zipcode (12.5 KB), so memory doesn't grow with
+    the file. Zipcodes are the same whatever their leading zeros ("00962"
+    and "962" would be the same postalcodes row), so those are duplicates.
 
+    A row is bad (and skipped) if it doesn't have enough columns, its
+    zipcode isn't a number of up to 5 digits (postalcodes.postalcode is an
+    integer column, so "K1A 0B1" can't be loaded), or its latitude and
+    longitude aren't numbers on the globe. 0, 0 counts as bad too, since
+    that's what the dataset has when it doesn't know. A first line whose
+    latitude isn't a number is a header, and is skipped.
 
-dict_of_zips = get_rid_of_duplicates('data/cityzip')
+"""
 
-write_to_new_file('data/cityzip_nodupes', dict_of_zips)
+CITYZIP_FILE = 'data/cityzip'
+NODUPES_FILE = 'data/cityzip_nodupes'
 
+# Columns of the cityzip file: state,city,zipcode,latitude,longitude,...
+ZIPCODE_COLUMN = 2
+LAT_COLUMN = 3
+LNG_COLUMN = 4
+
+# One more than the biggest 5 digit zipcode.
+NUM_ZIPCODES = 100000
+
+# How many bad rows to show line numbers for.
+BAD_ROWS_TO_SHOW = 10
+
+
+class ZipcodeBitmap(object):
+    """ Remembers which zipcodes have been seen, using one bit each. """
+
+    def __init__(self, size=NUM_ZIPCODES):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+
+    def add(self, zipcode):
+        """ Takes in a zipcode as a string of digits and marks it as seen.
+            Returns True if it was already seen.
+        """
+
+        byte, bit = divmod(int(zipcode), 8)
+        mask = 1 << bit
+        seen = self.bits[byte] & mask
+
+        self.bits[byte] |= mask
+
+        return bool(seen)
+
+
+def is_number(value):
+    """Returns True if a string is a number."""
+
+    try:
+        float(value)
+    except ValueError:
+        return False
+
+    return True
+
+
+def parse_row(row):
+    """ Takes in a line of the cityzip file and returns (zipcode, latitude,
+        longitude), all as the strings from the file. Returns None for a bad
+        row.
+    """
+
+    columns = row.strip().split(',')
+
+    if len(columns) <= LNG_COLUMN:
+        return None
+
+    zipcode = columns[ZIPCODE_COLUMN].strip()
+    lat = columns[LAT_COLUMN].strip()
+    lng = columns[LNG_COLUMN].strip()
+
+    if not (zipcode.isdigit() and int(zipcode) < NUM_ZIPCODES):
+        return None
+
+    if not (is_number(lat) and is_number(lng)):
+        return None
+
+    lat_value = float(lat)
+    lng_value = float(lng)
+
+    if not (-90 <= lat_value <= 90 and -180 <= lng_value <= 180):
+        return None
+
+    if lat_value == 0 and lng_value == 0:
+        return None
+
+    return zipcode, lat, lng
+
+
+def dedupe_postalcodes(input_path, output_path):
+    """ Reads a cityzip file and writes a load-ready file with one row per
+        zipcode. The output is written to a temporary file first, so a
+        failed run doesn't leave half a file behind.
+
+        Returns a dictionary of counts: rows read, rows written, duplicates,
+        bad rows, and whether a header was skipped, plus bad_lines, the line
+        numbers of the first few bad rows.
+
+    """
+
+    seen = ZipcodeBitmap()
+    counts = {'read': 0,
+              'written': 0,
+              'duplicates': 0,
+              'bad': 0,
+              'header': False,
+              'bad_lines': [],
+              }
+
+    temp_path = output_path + '.tmp'
+
+    with open(input_path) as source:
+        with open(temp_path, 'w') as target:
+            for line_number, row in enumerate(source, 1):
+                if not row.strip():
+                    continue
+
+                parsed = parse_row(row)
+
+                if parsed is None:
+                    columns = row.split(',')
+
+                    if (line_number == 1 and len(columns) > LAT_COLUMN and
+                            not is_number(columns[LAT_COLUMN].strip())):
+                        counts['header'] = True
+                        continue
+
+                    counts['read'] += 1
+                    counts['bad'] += 1
+
+                    if len(counts['bad_lines']) < BAD_ROWS_TO_SHOW:
+                        counts['bad_lines'].append(line_number)
+
+                    continue
+
+                counts['read'] += 1
+                zipcode, lat, lng = parsed
+
+                if seen.add(zipcode):
+                    counts['duplicates'] += 1
+                    continue
+
+                target.write('%s|%s|%s\n' % (zipcode, lat, lng))
+                counts['written'] += 1
+
+    os.rename(temp_path, output_path)
+
+    return counts
+
+
+if __name__ == "__main__":
+    input_path = sys.argv[1] if len(sys.argv) > 1 else CITYZIP_FILE
+    output_path = sys.argv[2] if len(sys.argv) > 2 else NODUPES_FILE
+
+    counts = dedupe_postalcodes(input_path, output_path)
+
+    if counts['header']:
+        print "Skipped header"
+
+    print "Read %d rows from %s" % (counts['read'], input_path)
+    print "Wrote %d zipcodes to %s" % (counts['written'], output_path)
+    print "Skipped %d duplicates" % counts['duplicates']
+    print "Skipped %d bad rows" % counts['bad']
+
+    if counts['bad_lines']:
+        print "Bad rows on lines: %s" % ', '.join(str(line_number) for line_number
+                                                 in counts['bad_lines'])
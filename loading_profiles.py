@@ -0,0 +1,91 @@
+from model import User, Product, History, Rating, Tent, SleepingBag, SleepingPad
+from sqlalchemy.orm import configure_mappers, joinedload, subqueryload
+
+"""
+    Loading profiles: the relationships each page's template touches, so the
+    page's queries can load them up front instead of one lazy load per row.
+
+    Each function returns a list of query options to pass to
+    query.options(*...). Many-to-one relationships (brand, category, owner,
+    renter) are joined into the same query. One-to-many collections (a
+    product's histories, a user's products) get one extra query for all of
+    them, since joining them in would repeat every parent row. So each page
+    makes the same number of queries however many rows it shows.
+
+    If a template starts using another relationship, add it here, or the
+    page goes back to one query per row for it.
+
+"""
+
+# Backrefs like User.products and History.product only show up on the classes
+# once the mappers are configured.
+configure_mappers()
+
+
+def for_search_cards():
+    """ For User queries whose products are shown as search result cards
+        (the search_radius, get_users_in_area, get_products_within_dates
+        path). Loads each user's products with their brands and categories.
+    """
+
+    return [subqueryload(User.products).joinedload(Product.brand),
+            subqueryload(User.products).joinedload(Product.category)]
+
+
+def for_product_detail():
+    """ For Product queries on the product detail and edit pages: the brand,
+        category, owner and owner's state, and the category-specific specs
+        (Product.details) with their own lookups, all in one query. Products
+        only have one subset row, so the other subset joins come back empty.
+    """
+
+    return [joinedload(Product.brand),
+            joinedload(Product.category),
+            joinedload(Product.owner).joinedload(User.region),
+            joinedload(Product.tent).joinedload(Tent.bestuse),
+            joinedload(Product.sleepingbag).joinedload(SleepingBag.filltype),
+            joinedload(Product.sleepingbag).joinedload(SleepingBag.gender),
+            joinedload(Product.sleepingpad).joinedload(SleepingPad.padtype),
+            joinedload(Product.sleepingpad).joinedload(SleepingPad.bestuse)]
+
+
+def for_account_inventory():
+    """ For Product queries on the account page: the user's own inventory,
+        with each product's brand and category.
+    """
+
+    return [joinedload(Product.brand),
+            joinedload(Product.category)]
+
+
+def for_account_requests():
+    """ For History queries on the account page: rentals of the user's own
+        products, with each renter and each product's brand and category.
+    """
+
+    return [joinedload(History.renter),
+            joinedload(History.product).joinedload(Product.brand),
+            joinedload(History.product).joinedload(Product.category)]
+
+
+def for_account_rentals():
+    """ For History queries on the account page: things the user has
+        rented, with each product's brand, category, and owner.
+    """
+
+    return [joinedload(History.product).joinedload(Product.brand),
+            joinedload(History.product).joinedload(Product.category),
+            joinedload(History.product).joinedload(Product.owner)]
+
+
+def for_rating_rows(kind):
+    """ For Rating queries on the owner and renter ratings pages, which link
+        each rating to the product it was for. kind is 'owner' or 'renter'.
+    """
+
+    if kind == 'owner':
+        history = Rating.ohistory
+    else:
+        history = Rating.rhistory
+
+    return [joinedload(history).joinedload(History.product).joinedload(Product.brand)]
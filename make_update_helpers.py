@@ -2,8 +2,15 @@ from flask import request, session
 from model import User, Region, Brand, Product, Tent
 from model import SleepingBag, SleepingPad, PostalCode, db
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import text, func
 from datetime import datetime
-from geolocation.google_maps import GoogleMaps
+from geocoder import cached_geocode
+from postalcode_index import refresh_postalcode_index
+from autocomplete import get_brand_index, add_brand_to_index, add_model_to_index
+from autocomplete import normalize_name
+from reference_data import bump_reference_data_version
+from distance_helpers import invalidate_zip_distances
+from search_cache import invalidate_search_results_near
 import os
 
 """
@@ -23,23 +30,37 @@ import os
 
 def make_postalcode(postalcode_string):
     """
-        Takes in zipcode as a string, gets lat and long info using the GoogleMaps
-        API, and adds the zipcode to the PostalCodes table.
+        Takes in zipcode as a string, gets lat and long info from the offline
+        geocoder (which only falls back on the GoogleMaps API for zipcodes it
+        doesn't know), and adds the zipcode to the PostalCodes table.
+
+        Returns the new PostalCode object, or None if the zipcode couldn't be
+        found. Geocoder results, including not found, are cached (see
+        geocoder.GeocodeCache).
 
     """
-    google_maps = GoogleMaps(api_key=os.environ['GOOGLE_API_KEY'])
-    location = google_maps.search(location=postalcode_string).first()
+    location = cached_geocode(postalcode_string)
 
-    print "\n\n\n\n Google Maps API: location is %r \n\n" % location
+    if not location:
+        print "\n\n\n\n COULD NOT FIND POSTALCODE %r \n\n" % postalcode_string
+        return None
 
-    a = PostalCode(postalcode=int(postalcode_string), latitude=location.lat,
-                   longitude=location.lng)
+    a = PostalCode(postalcode=int(postalcode_string), latitude=location[0],
+                   longitude=location[1])
 
     db.session.add(a)
     db.session.commit()
 
-    temp = PostalCode.query.get(int(postalcode_string))
-    print "****************\n\n\n\n\n MADE POSTALCODE %r\n\n\n\n\n*************" % temp
+    # Keep the in-memory postal code index used by search_radius in sync, and
+    # throw away saved search distances and cached search results that should
+    # now include this zipcode.
+    refresh_postalcode_index(postalcode_string)
+    invalidate_zip_distances(postalcode_string)
+    invalidate_search_results_near(postalcode_string)
+
+    print "****************\n\n\n\n\n MADE POSTALCODE %r\n\n\n\n\n*************" % a
+
+    return a
 
 
 def make_user(password):
@@ -93,16 +114,35 @@ def check_brand(brand_id):
 
         Takes integer brand_id (which will be -1 if it is a new brand),
         and returns integer brand_id (which, for a new brand, will be the
-        brand_id for the newly created Brand object).
+        brand_id for the newly created Brand object), or None if the brand
+        name was left blank.
+
+        If the "new" brand is an existing brand typed with different case or
+        spacing (e.g. "the north face"), we use the existing brand instead of
+        making a near-duplicate.
 
     """
 
     if brand_id < 0:
-        new_brand_name = request.form.get("new_brand_name")
-        brand = Brand(brand_name=new_brand_name)
-        db.session.add(brand)
-        db.session.commit()
-        brand_id = brand.brand_id
+        new_brand_name = request.form.get("new_brand_name", "").strip()
+
+        if not new_brand_name:
+            return None
+
+        brand_id = get_brand_index().find(new_brand_name)
+
+        if brand_id is None:
+            # Another process may have added the brand since our index was
+            # built, so check the database before making a new one.
+            brand = Brand.query.filter(
+                func.lower(Brand.brand_name) == normalize_name(new_brand_name)).first()
+
+            if brand is None:
+                brand = make_brand(new_brand_name)
+            else:
+                add_brand_to_index(brand)
+
+            brand_id = brand.brand_id
 
     return brand_id
 
@@ -110,12 +150,19 @@ def check_brand(brand_id):
 def make_brand(brandname):
     """ Adds a new brand to the database. This is called by the check_brand
         function above if a new brand needs to be added to the database.
+        Returns the new Brand object.
     """
     brand = Brand(brand_name=brandname)
 
     db.session.add(brand)
     db.session.commit()
 
+    add_brand_to_index(brand)
+    # The brand drop downs come from the reference data cache.
+    bump_reference_data_version()
+
+    return brand
+
 
 def get_brand_id(brandname):
     """Takes brand name as a string and returns brand_id as an integer."""
@@ -154,6 +201,8 @@ def make_parent_product(brand_id, category_id):
                       avail_start_date=avail_start, avail_end_date=avail_end,
                       price_per_day=pricing, image_url=image)
 
+    add_model_to_index(modelname, brand_id)
+
     return product
 
 
@@ -253,6 +302,34 @@ def make_sleeping_pad(product_id):
     return sleeping_pad
 
 
+# Model names and brands count the most in keyword searches, then
+# descriptions, then conditions.
+SEARCH_VECTOR_SQL = """
+    UPDATE products SET search_vector =
+        setweight(to_tsvector('english', coalesce(products.model, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(brands.brand_name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(products.description, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(products.condition, '')), 'C')
+    FROM brands
+    WHERE products.brand_id = brands.brand_id
+"""
+
+
+def update_search_vector(prod_id=None):
+    """ Rebuilds the full text search document for one product, or for every
+        product if prod_id is None. Call this after a product's model, brand,
+        description, or condition changes.
+    """
+
+    if prod_id is None:
+        db.session.execute(text(SEARCH_VECTOR_SQL))
+    else:
+        db.session.execute(text(SEARCH_VECTOR_SQL + " AND products.prod_id = :prod_id"),
+                           {'prod_id': prod_id})
+
+    db.session.commit()
+
+
 ###################### Editing stuff ################################
 def update_parent_product(prod_id, brand_id):
     """ Updates parent Product attributes.
@@ -282,6 +359,9 @@ def update_parent_product(prod_id, brand_id):
 
     db.session.commit()
 
+    add_model_to_index(product.model, brand_id)
+    update_search_vector(prod_id)
+
     return
 
 
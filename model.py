@@ -1,11 +1,13 @@
 # Models and database for Happy Camper Hackbright project.
 # Version 2:January 7, 2015
 
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from db_config import ConfiguredSQLAlchemy, get_db_profile, configure_engine
+from db_config import install_pre_ping
 import datetime
 import os
 
-db = SQLAlchemy()
+db = ConfiguredSQLAlchemy()
 
 ##############################################################
 
@@ -131,12 +133,23 @@ class Product(db.Model):
     # figure out.
     image_url = db.Column(db.String(128))
 
+    # Full text search document made from the model, brand, description, and
+    # condition. Kept up to date by make_update_helpers.update_search_vector.
+    search_vector = db.Column(TSVECTOR)
+
     # Put subset table backrefs here so we can easily access parent product info
     # while on a subset object.
     tent = db.relationship('Tent', uselist=False, backref='product')
     sleepingbag = db.relationship('SleepingBag', uselist=False, backref='product')
     sleepingpad = db.relationship('SleepingPad', uselist=False, backref='product')
 
+    # Which of the relationships above has the specs for each cat_id. A new
+    # category gets a subset table, a relationship, and an entry here.
+    CATEGORY_DETAILS = {1: 'tent',
+                        2: 'sleepingbag',
+                        3: 'sleepingpad',
+                        }
+
     # Other backrefs. We want to be able to see which products an user has
     # available for rent, which products we have of a certain brand or
     # category, and the product associated with a history.
@@ -145,6 +158,25 @@ class Product(db.Model):
     category = db.relationship('Category', backref='products')
     histories = db.relationship('History', backref='product')
 
+    # For "what's available for these dates" searches.
+    __table_args__ = (db.Index('ix_products_available_dates', 'available',
+                               'avail_start_date', 'avail_end_date'),
+                      db.Index('ix_products_search_vector', 'search_vector',
+                               postgresql_using='gin'))
+
+    @property
+    def details(self):
+        """ The Tent, SleepingBag, or SleepingPad with this product's
+            category-specific specs, or None if its category has none.
+        """
+
+        relationship_name = self.CATEGORY_DETAILS.get(self.cat_id)
+
+        if relationship_name is None:
+            return None
+
+        return getattr(self, relationship_name)
+
     def __repr__(self):
         return "<Product prod_id=%d, cat_id=%d, owner_id=%d, brand_id: %d, model=%s, description=%s, condition=%s, avail=%r to %r, price=%r>" % (
             self.prod_id, self.cat_id, self.owner_user_id, self.brand_id, self.model,
@@ -280,6 +312,16 @@ class History(db.Model):
     renter_rating_id = db.Column(db.Integer, db.ForeignKey('ratings.rating_id'))
     prod_rating_id = db.Column(db.Integer, db.ForeignKey('ratings.rating_id'))
 
+    # Histories double as bookings (see booking_helpers), so index them for
+    # "is this product booked for these dates" checks, and for the account
+    # page's newest first lists by product and by renter.
+    __table_args__ = (db.Index('ix_histories_prod_dates', 'prod_id',
+                               'start_date', 'end_date'),
+                      db.Index('ix_histories_prod_submitted', 'prod_id',
+                               'rental_submission_date'),
+                      db.Index('ix_histories_renter_submitted', 'renter_user_id',
+                               'rental_submission_date'))
+
     # Took a while to figure out how to be on a rating and find the associated product
     # without annoyingly long queries.
     # I used this so I can show owner and renter ratings across all products they've
@@ -330,23 +372,118 @@ class PostalCode(db.Model):
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
 
+    # For the bounding box prefilter in distance_helpers.
+    __table_args__ = (db.Index('ix_postalcodes_latitude_longitude',
+                               'latitude', 'longitude'),)
+
     def __repr__(self):
         return "<postalcode=%d, latitude=%f, longitude=%f>" % (self.postalcode,
                                                                self.latitude,
                                                                self.longitude)
 
+
+class ZipDistance(db.Model):
+    """ Saved distances between a search center postal code and the postal
+        codes around it, so repeat searches from the same center are a single
+        range scan on (center, miles) instead of a distance calculation.
+
+        Filled in by distance_helpers the first time a center is searched.
+    """
+
+    __tablename__ = 'zip_distances'
+
+    center = db.Column(db.Integer, db.ForeignKey('postalcodes.postalcode'),
+                       primary_key=True)
+    neighbor = db.Column(db.Integer, db.ForeignKey('postalcodes.postalcode'),
+                         primary_key=True)
+    miles = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (db.Index('ix_zip_distances_center_miles', 'center', 'miles'),)
+
+    def __repr__(self):
+        return "<ZipDistance center=%d, neighbor=%d, miles=%f>" % (self.center,
+                                                                  self.neighbor,
+                                                                  self.miles)
+
+
+class ZipDistanceCenter(db.Model):
+    """ Search centers that have saved distances in zip_distances, and the
+        radius in miles the saved distances cover.
+    """
+
+    __tablename__ = 'zip_distance_centers'
+
+    center = db.Column(db.Integer, db.ForeignKey('postalcodes.postalcode'),
+                       primary_key=True)
+    max_miles = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return "<ZipDistanceCenter center=%d, max_miles=%f>" % (self.center,
+                                                               self.max_miles)
+
+
+class RatingSummary(db.Model):
+    """ Running totals of star ratings for an owner, a renter, or a product,
+        so rating pages don't have to walk every history to get an average.
+
+        kind is 'owner', 'renter', or 'product', and subject_id is the
+        user_id or prod_id being rated. Kept up to date by rating_helpers.
+    """
+
+    __tablename__ = 'rating_summaries'
+
+    kind = db.Column(db.String(8), primary_key=True)
+    subject_id = db.Column(db.Integer, primary_key=True)
+    num_ratings = db.Column(db.Integer, nullable=False, default=0)
+    total_stars = db.Column(db.Integer, nullable=False, default=0)
+    # How many ratings had each number of stars (ratings are out of 4).
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+
+    def average(self):
+        """ Returns the average star rating as a float, or -1 if there are no
+            ratings (same as calc_avg_star_rating).
+        """
+
+        if not self.num_ratings:
+            return -1
+
+        return float(self.total_stars) / self.num_ratings
+
+    def histogram(self):
+        """ Returns a list of (stars, count) tuples, most stars first."""
+
+        return [(4, self.stars_4 or 0), (3, self.stars_3 or 0),
+                (2, self.stars_2 or 0), (1, self.stars_1 or 0)]
+
+    def __repr__(self):
+        return "<RatingSummary kind=%s, subject_id=%d, num_ratings=%r, total_stars=%r>" % (
+            self.kind, self.subject_id, self.num_ratings, self.total_stars)
+
 ##############################################################################
 
-def connect_to_db(app, db_uri=None):
-    """Connect the database to our Flask app."""
+def connect_to_db(app, db_uri=None, profile_name=None):
+    """ Connect the database to our Flask app.
+
+        Engine settings (echo, pool sizes, timeouts) come from a profile in
+        db_config.py, picked by profile_name or the HAPPYCAMPER_ENV
+        environment variable.
+
+    """
 
     postgrespassword = os.environ['POSTGRES_PASSWORD']
+    profile = get_db_profile(profile_name)
 
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri or 'postgresql://%s/happycamper' % postgrespassword
-    app.config['SQLALCHEMY_ECHO'] = True
+    configure_engine(app, profile)
     db.app = app
     db.init_app(app)
 
+    if profile['pre_ping']:
+        install_pre_ping(db.engine)
+
 
 if __name__ == "__main__":
     # This allows direct database interaction if this module is run interactively.
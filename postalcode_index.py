@@ -0,0 +1,207 @@
+from model import PostalCode, db
+from array import array
+import math
+
+"""
+    Process-wide spatial index over the PostalCodes table.
+
+    Postal codes are bucketed into a uniform latitude/longitude grid so a
+    radius search only has to look at the handful of grid cells around the
+    search center instead of querying the database once per zipcode.
+
+    The index is built lazily from the PostalCodes table the first time it is
+    needed. make_postalcode calls refresh_postalcode_index when it adds a new
+    row, and seed.clear_data calls clear_postalcode_index when the tables are
+    dropped.
+
+"""
+
+# One degree of latitude is about 69 miles everywhere. One degree of
+# longitude is about 69 miles at the equator and shrinks to zero at the poles.
+MILES_PER_DEGREE = 69.0
+
+# Half a degree is roughly 35 x 35 miles in the Bay Area, so a typical search
+# touches a few cells with a few dozen zipcodes each.
+CELL_SIZE_DEGREES = 0.5
+
+
+class PostalCodeIndex(object):
+    """ Uniform lat/lng grid of postal codes.
+
+        Each cell is keyed by (row, column) and holds parallel arrays of
+        zipcodes, latitudes, and longitudes so candidates can be handed
+        straight to the distance calculation.
+
+    """
+
+    def __init__(self, cell_size=CELL_SIZE_DEGREES):
+        self.cell_size = cell_size
+        self.num_columns = int(math.ceil(360 / cell_size))
+        self.cells = {}
+        self.locations = {}
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, postalcode):
+        return int(postalcode) in self.locations
+
+    def _cell_for(self, lat, lng):
+        """Returns (row, column) of the grid cell containing a lat and long."""
+
+        row = int(math.floor((lat + 90) / self.cell_size))
+        column = int(math.floor((lng + 180) / self.cell_size)) % self.num_columns
+
+        return (row, column)
+
+    def add(self, postalcode, lat, lng):
+        """ Adds a postal code to the index. Re-adding a postal code moves it
+            to its new location.
+        """
+
+        postalcode = int(postalcode)
+
+        if postalcode in self.locations:
+            self.remove(postalcode)
+
+        cell = self.cells.get(self._cell_for(lat, lng))
+
+        if cell is None:
+            cell = (array('i'), array('d'), array('d'))
+            self.cells[self._cell_for(lat, lng)] = cell
+
+        cell[0].append(postalcode)
+        cell[1].append(lat)
+        cell[2].append(lng)
+
+        self.locations[postalcode] = (lat, lng)
+
+    def remove(self, postalcode):
+        """Removes a postal code from the index if it is there."""
+
+        postalcode = int(postalcode)
+        location = self.locations.pop(postalcode, None)
+
+        if location is None:
+            return
+
+        zipcodes, lats, lngs = self.cells[self._cell_for(*location)]
+        idx = zipcodes.index(postalcode)
+
+        del zipcodes[idx]
+        del lats[idx]
+        del lngs[idx]
+
+    def get(self, postalcode):
+        """ Takes in postal code as an integer or string and returns a tuple
+            of (latitude, longitude), or None if it isn't in the index.
+        """
+
+        return self.locations.get(int(postalcode))
+
+    def _rows_and_columns(self, lat, lng, radius):
+        """ Finds the grid rows and columns a search circle can touch.
+
+            The longitude span grows as 1 / cos(latitude), so near the poles
+            (and for huge radii) we give up and scan every column. Column
+            numbers wrap around so searches near the antimeridian (e.g. the
+            Aleutians) pick up cells on both sides.
+
+        """
+
+        lat_span = radius / MILES_PER_DEGREE
+
+        min_row = int(math.floor((max(lat - lat_span, -90) + 90) / self.cell_size))
+        max_row = int(math.floor((min(lat + lat_span, 90) + 90) / self.cell_size))
+
+        # Use the latitude closest to a pole within the search circle, since
+        # that is where the longitude span is widest.
+        widest_lat = min(abs(lat) + lat_span, 90)
+        cos_lat = math.cos(math.radians(widest_lat))
+
+        if cos_lat < 1e-6 or radius / (MILES_PER_DEGREE * cos_lat) >= 180:
+            columns = range(self.num_columns)
+        else:
+            lng_span = radius / (MILES_PER_DEGREE * cos_lat)
+            first = int(math.floor((lng - lng_span + 180) / self.cell_size))
+            last = int(math.floor((lng + lng_span + 180) / self.cell_size))
+            columns = [column % self.num_columns for column in range(first, last + 1)]
+
+        return range(min_row, max_row + 1), columns
+
+    def candidates(self, lat, lng, radius):
+        """ Finds postal codes in the grid cells that overlap a search circle.
+
+            Takes in latitude and longitude of the search center and radius in
+            miles, and returns three parallel arrays of zipcodes, latitudes,
+            and longitudes. Every postal code within the radius is included,
+            along with some that are just outside it, so callers still need to
+            check the exact distance.
+
+        """
+
+        zipcodes = array('i')
+        lats = array('d')
+        lngs = array('d')
+
+        rows, columns = self._rows_and_columns(lat, lng, radius)
+
+        for row in rows:
+            for column in columns:
+                cell = self.cells.get((row, column))
+
+                if cell:
+                    zipcodes.extend(cell[0])
+                    lats.extend(cell[1])
+                    lngs.extend(cell[2])
+
+        return zipcodes, lats, lngs
+
+
+_postalcode_index = None
+
+
+def get_postalcode_index():
+    """ Returns the process-wide postal code index, building it from the
+        PostalCodes table the first time it's called.
+    """
+
+    global _postalcode_index
+
+    if _postalcode_index is None:
+        index = PostalCodeIndex()
+        query = db.session.query(PostalCode.postalcode, PostalCode.latitude,
+                                 PostalCode.longitude)
+
+        for postalcode, lat, lng in query:
+            index.add(postalcode, lat, lng)
+
+        _postalcode_index = index
+
+    return _postalcode_index
+
+
+def refresh_postalcode_index(postalcode):
+    """ Updates the index after a postal code is added or changed in the
+        database. Does nothing if the index hasn't been built yet, since it
+        will pick up the new row when it is.
+    """
+
+    if _postalcode_index is None:
+        return
+
+    location = PostalCode.query.get(int(postalcode))
+
+    if location:
+        _postalcode_index.add(location.postalcode, location.latitude,
+                              location.longitude)
+    else:
+        _postalcode_index.remove(postalcode)
+
+
+def clear_postalcode_index():
+    """Throws away the index so it is rebuilt on next use."""
+
+    global _postalcode_index
+
+    _postalcode_index = None
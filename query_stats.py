@@ -0,0 +1,98 @@
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import time
+
+"""
+    Per-request SQL statement counts and timings.
+
+    Every statement run while handling a request is counted in a QueryStats
+    on flask.g, using SQLAlchemy's before/after_cursor_execute engine events.
+    After the request, the totals go in the response headers
+    (X-Query-Count, X-Query-Time-Ms, X-Slowest-Query-Ms) and are printed on
+    one line. That way we can see what a route costs without turning on
+    SQLALCHEMY_ECHO.
+
+    camper_tests.py checks the X-Query-Count header against a query budget
+    for each route, so a page that goes back to one query per row fails the
+    tests.
+
+"""
+
+# How much of the slowest statement to print.
+SLOWEST_STATEMENT_CHARS = 200
+
+
+class QueryStats(object):
+    """Number of statements, total seconds, and the slowest statement."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement, seconds):
+        """Counts one statement that took seconds to run."""
+
+        self.count += 1
+        self.total_seconds += seconds
+
+        if seconds >= self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Notes when a statement starts."""
+
+    if context is not None:
+        context._query_stats_start = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Adds a finished statement to the current request's stats, if any."""
+
+    start = getattr(context, '_query_stats_start', None)
+
+    if start is None or not has_request_context():
+        return
+
+    stats = getattr(g, 'query_stats', None)
+
+    if stats is not None:
+        stats.record(statement, time.time() - start)
+
+
+def install_query_stats(app):
+    """ Starts counting statements for each of app's requests. Call this
+        once, right after making the app.
+    """
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = getattr(g, 'query_stats', None)
+
+        if stats is None:
+            return response
+
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time-Ms'] = '%.1f' % (stats.total_seconds * 1000)
+        response.headers['X-Slowest-Query-Ms'] = '%.1f' % (stats.slowest_seconds * 1000)
+
+        slowest = ' '.join((stats.slowest_statement or '').split())
+
+        print "%s %s: %d queries, %.1f ms in db, slowest %.1f ms: %s" % (
+            request.method, request.path, stats.count,
+            stats.total_seconds * 1000, stats.slowest_seconds * 1000,
+            slowest[:SLOWEST_STATEMENT_CHARS])
+
+        return response
@@ -0,0 +1,184 @@
+from model import History, Product, Rating, RatingSummary, connect_to_db, db
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func
+
+"""
+    Helper functions for the rating_summaries table.
+
+    Each owner, renter, and product has a RatingSummary with the number of
+    star ratings, the total stars, and how many ratings had each number of
+    stars, so rating pages and search results can show averages without
+    loading every history and rating.
+
+    The rating handlers call update_rating_summary before they commit, so a
+    summary changes in the same transaction as the rating it counts. The
+    update is a single UPDATE ... SET num_ratings = num_ratings + 1, so
+    ratings submitted at the same time don't overwrite each other.
+
+    If the summaries ever get out of step with the histories, run
+    python rating_helpers.py to rebuild them all.
+
+"""
+
+# Ratings are out of 4 stars.
+MAX_STARS = 4
+
+
+def empty_rating_summary(kind, subject_id):
+    """Returns an unsaved RatingSummary with no ratings."""
+
+    summary = RatingSummary(kind=kind, subject_id=subject_id, num_ratings=0,
+                            total_stars=0)
+
+    for stars in range(1, MAX_STARS + 1):
+        setattr(summary, 'stars_%d' % stars, 0)
+
+    return summary
+
+
+def rating_subject_id(kind, history):
+    """ Takes in a kind of rating and a History, and returns who or what the
+        rating is about: the product's owner, the renter, or the product.
+    """
+
+    if kind == 'owner':
+        return history.product.owner_user_id
+    elif kind == 'renter':
+        return history.renter_user_id
+    else:
+        return history.prod_id
+
+
+def update_rating_summary(kind, subject_id, stars, old_stars=None):
+    """ Counts a new star rating in a summary.
+
+        If old_stars is given, the rating replaces an earlier one with that
+        many stars instead of adding to the number of ratings. Doesn't commit,
+        so the caller can commit the summary along with the rating.
+
+    """
+
+    # Column name to how much it changes by.
+    deltas = {'total_stars': stars - (old_stars or 0)}
+
+    if old_stars is None:
+        deltas['num_ratings'] = 1
+    elif 1 <= old_stars <= MAX_STARS:
+        deltas['stars_%d' % old_stars] = -1
+
+    if 1 <= stars <= MAX_STARS:
+        column_name = 'stars_%d' % stars
+        deltas[column_name] = deltas.get(column_name, 0) + 1
+
+    changes = dict((getattr(RatingSummary, column_name),
+                    getattr(RatingSummary, column_name) + delta)
+                   for column_name, delta in deltas.iteritems())
+
+    query = RatingSummary.query.filter(RatingSummary.kind == kind,
+                                       RatingSummary.subject_id == subject_id)
+
+    if query.update(changes, synchronize_session=False):
+        return
+
+    # First rating for this subject. Insert in a savepoint in case someone
+    # else inserts it first, in which case we update theirs.
+    summary = empty_rating_summary(kind, subject_id)
+
+    for column_name, delta in deltas.iteritems():
+        setattr(summary, column_name, delta)
+
+    db.session.begin_nested()
+
+    try:
+        db.session.add(summary)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        query.update(changes, synchronize_session=False)
+
+
+def get_rating_summary(kind, subject_id):
+    """ Returns the RatingSummary for an owner, renter, or product (an empty
+        one if there are no ratings yet).
+    """
+
+    summary = RatingSummary.query.get((kind, subject_id))
+
+    if summary is None:
+        summary = empty_rating_summary(kind, subject_id)
+
+    return summary
+
+
+def get_rating_summaries(kind, subject_ids):
+    """ Takes in a kind and a list of user_ids or prod_ids, and returns a
+        dictionary of id to RatingSummary, using one query.
+    """
+
+    summaries = {}
+
+    if subject_ids:
+        query = RatingSummary.query.filter(RatingSummary.kind == kind,
+                                           RatingSummary.subject_id.in_(subject_ids))
+
+        for summary in query:
+            summaries[summary.subject_id] = summary
+
+    for subject_id in subject_ids:
+        if subject_id not in summaries:
+            summaries[subject_id] = empty_rating_summary(kind, subject_id)
+
+    return summaries
+
+
+def rebuild_rating_summaries():
+    """ Throws away every RatingSummary and recounts them from the histories
+        and ratings tables. Returns how many summaries were made.
+    """
+
+    subjects = {'owner': (Product.owner_user_id, History.owner_rating_id),
+                'renter': (History.renter_user_id, History.renter_rating_id),
+                'product': (History.prod_id, History.prod_rating_id),
+                }
+
+    RatingSummary.query.delete()
+
+    summaries = {}
+
+    for kind, (subject_column, rating_id_column) in subjects.iteritems():
+        query = db.session.query(subject_column, Rating.stars,
+                                 func.count(Rating.rating_id))
+        query = query.select_from(History).join(Rating, Rating.rating_id == rating_id_column)
+
+        if kind == 'owner':
+            query = query.join(Product, Product.prod_id == History.prod_id)
+
+        query = query.group_by(subject_column, Rating.stars)
+
+        for subject_id, stars, count in query:
+            summary = summaries.get((kind, subject_id))
+
+            if summary is None:
+                summary = empty_rating_summary(kind, subject_id)
+                summaries[(kind, subject_id)] = summary
+
+            summary.num_ratings += count
+            summary.total_stars += stars * count
+
+            if 1 <= stars <= MAX_STARS:
+                column_name = 'stars_%d' % stars
+                setattr(summary, column_name, getattr(summary, column_name) + count)
+
+    db.session.add_all(summaries.values())
+    db.session.commit()
+
+    return len(summaries)
+
+
+if __name__ == "__main__":
+    # Repair command: python rating_helpers.py
+
+    from server import app
+    connect_to_db(app)
+
+    print "Rebuilt %d rating summaries." % rebuild_rating_summaries()
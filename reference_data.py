@@ -0,0 +1,107 @@
+from model import Region, Category, BestUse, Brand, FillType, Gender, PadType
+from collections import namedtuple
+import threading
+import time
+
+"""
+    In-process cache of the small lookup tables (regions, categories, best
+    uses, brands, fill types, genders, and pad types) that fill the drop
+    downs on most pages.
+
+    The tables are loaded together the first time they're needed, into
+    namedtuples with the same field names as the model columns, so
+    templates can use them just like the model objects. Namedtuples can't
+    be changed, so nothing can edit the cached rows by accident.
+
+    The only one that changes while the site is running is brands, when
+    someone lists gear from a new brand. make_brand calls
+    bump_reference_data_version, and the cache reloads the next time it's
+    used. That only reaches the process that made the brand, so cached data
+    also expires after REFERENCE_DATA_TTL seconds so other workers catch up.
+
+"""
+
+REFERENCE_DATA_TTL = 10 * 60
+
+RegionRecord = namedtuple('RegionRecord', ['region_id', 'abbr', 'full'])
+CategoryRecord = namedtuple('CategoryRecord', ['cat_id', 'cat_name'])
+BestUseRecord = namedtuple('BestUseRecord', ['use_id', 'use_name'])
+BrandRecord = namedtuple('BrandRecord', ['brand_id', 'brand_name'])
+FillTypeRecord = namedtuple('FillTypeRecord', ['fill_code', 'fill_name'])
+GenderRecord = namedtuple('GenderRecord', ['gender_code', 'gender_name'])
+PadTypeRecord = namedtuple('PadTypeRecord', ['pad_type_code', 'pad_type_name'])
+
+
+def load_records(model, record_class):
+    """ Takes in a model and a namedtuple class with some of its column names
+        as fields, and returns a tuple of records for every row, in primary
+        key order.
+    """
+
+    columns = [getattr(model, field) for field in record_class._fields]
+    query = model.query.with_entities(*columns).order_by(columns[0])
+
+    return tuple(record_class(*row) for row in query)
+
+
+class ReferenceData(object):
+    """ One load of every lookup table. Each table is a tuple of records
+        (e.g. reference.brands), and regions can be looked up by id.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.expires = time.time() + REFERENCE_DATA_TTL
+
+        self.regions = load_records(Region, RegionRecord)
+        self.categories = load_records(Category, CategoryRecord)
+        self.best_uses = load_records(BestUse, BestUseRecord)
+        self.brands = load_records(Brand, BrandRecord)
+        self.fill_types = load_records(FillType, FillTypeRecord)
+        self.genders = load_records(Gender, GenderRecord)
+        self.pad_types = load_records(PadType, PadTypeRecord)
+
+        self.regions_by_id = dict((region.region_id, region) for region in self.regions)
+
+
+_version = 0
+_reference_data = None
+_lock = threading.Lock()
+
+
+def bump_reference_data_version():
+    """ Marks the cached reference data as out of date. Call this after
+        adding or changing a row in one of the lookup tables.
+    """
+
+    global _version
+
+    with _lock:
+        _version += 1
+
+
+def get_reference_data():
+    """ Returns the process-wide ReferenceData, loading it if it hasn't been
+        loaded, is out of date, or has expired.
+    """
+
+    global _reference_data
+
+    with _lock:
+        reference = _reference_data
+
+        if (reference is None or reference.version != _version or
+                reference.expires <= time.time()):
+            reference = ReferenceData(_version)
+            _reference_data = reference
+
+    return reference
+
+
+def clear_reference_data():
+    """Throws away the cached reference data so it's reloaded on next use."""
+
+    global _reference_data
+
+    with _lock:
+        _reference_data = None
@@ -0,0 +1,163 @@
+from distance_helpers import calc_Haversine_distance
+from postalcode_index import get_postalcode_index
+from collections import OrderedDict
+import threading
+import time
+
+"""
+    Cache of search results pages, so people running the same search (same
+    center, radius, dates, category, brand, and keywords) don't each run the
+    search queries.
+
+    Each entry only keeps product ids. Entries are thrown away when a listing
+    changes in a way that could change them:
+        - a product that is in an entry is rented, delisted, edited, or its
+          owner deactivates his or her account
+        - a product is listed or edited near an entry's search center, since
+          it might now show up in that search
+
+    The cache is per process, so entries also expire after SEARCH_CACHE_TTL
+    seconds to limit how stale other workers can get.
+
+"""
+
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 5 * 60
+
+
+class SearchResultCache(object):
+    """ Least recently used cache of search results pages. """
+
+    def __init__(self, max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Maps key to a dictionary with prod_ids (set), lat, lng, radius,
+        # expires, and whatever value was cached.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None or entry['expires'] <= time.time():
+                self.misses += 1
+                return None
+
+            # Move to the most recently used end.
+            self.entries[key] = entry
+            self.hits += 1
+
+            return entry['value']
+
+    def put(self, key, value, prod_ids, lat, lng, radius):
+        """ Caches a value.
+
+            Takes in the cache key, the value, the product ids in the value
+            (for invalidation), and the latitude, longitude, and radius of the
+            search.
+
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+            self.entries[key] = {'value': value,
+                                 'prod_ids': set(prod_ids),
+                                 'lat': lat,
+                                 'lng': lng,
+                                 'radius': radius,
+                                 'expires': time.time() + self.ttl,
+                                 }
+
+    def _remove(self, keys):
+        """Removes entries. Must be called with the lock held."""
+
+        for key in keys:
+            del self.entries[key]
+
+        self.invalidations += len(keys)
+
+    def invalidate_products(self, prod_ids):
+        """Throws away entries that include any of the given products."""
+
+        prod_ids = set(prod_ids)
+
+        with self.lock:
+            self._remove([key for key, entry in self.entries.iteritems()
+                          if entry['prod_ids'] & prod_ids])
+
+    def invalidate_location(self, lat, lng):
+        """Throws away entries whose search area includes a lat and long."""
+
+        with self.lock:
+            self._remove([key for key, entry in self.entries.iteritems()
+                          if calc_Haversine_distance(entry['lat'], entry['lng'],
+                                                     lat, lng) <= entry['radius']])
+
+    def clear(self):
+        """Throws away every entry."""
+
+        with self.lock:
+            self._remove(self.entries.keys())
+
+    def stats(self):
+        """ Returns a dictionary of hits, misses, hit ratio, evictions,
+            invalidations, and current size.
+        """
+
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            if lookups:
+                hit_ratio = float(self.hits) / lookups
+            else:
+                hit_ratio = 0.0
+
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': hit_ratio,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'size': len(self.entries),
+                    }
+
+
+search_result_cache = SearchResultCache()
+
+
+def invalidate_search_results_for_products(prod_ids):
+    """ Throws away cached search results that include any of the given
+        products. Used when products are rented or delisted.
+    """
+
+    search_result_cache.invalidate_products(prod_ids)
+
+
+def invalidate_search_results_near(postalcode):
+    """ Throws away cached search results whose search area includes a postal
+        code. Used when a product is listed or edited, since it might now show
+        up in searches around its owner. If we don't know where the postal
+        code is, everything is thrown away.
+    """
+
+    location = get_postalcode_index().get(postalcode)
+
+    if location:
+        search_result_cache.invalidate_location(location[0], location[1])
+    else:
+        search_result_cache.clear()
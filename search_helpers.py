@@ -1,97 +1,422 @@
-from model import User, PostalCode, db
+from model import User, PostalCode, Product, Brand, Category, ZipDistance, History, db
 from datetime import datetime, timedelta
-from geolocation.google_maps import GoogleMaps
-from geolocation.distance_matrix import const
 from make_update_helpers import make_postalcode
+from postalcode_index import get_postalcode_index, refresh_postalcode_index
+from distance_helpers import calc_Haversine_distance, calc_Haversine_distances
+from distance_helpers import get_nearby_postalcodes, get_postalcodes_in_bounding_box
+from distance_helpers import ensure_zip_distances
+from search_cache import search_result_cache
+from booking_helpers import overlapping_bookings, find_booked_products
+from loading_profiles import for_search_cards
+from sqlalchemy import and_, cast, func, tuple_, Integer
 from sqlalchemy.orm.exc import NoResultFound
 import os
-import math
 
 """
     Helper functions for server.py search-related routes.
 
 """
 
+# Number of products to show per category on a search results page.
+SEARCH_PAGE_SIZE = 12
 
-def calc_Haversine_distance(lat1, lng1, lat2, lng2):
-    """
-        Uses the Haversine formual to calculate the distance in miles between two
-        pairs of lat and longs.
 
-    """
+def get_search_center(search_center_string):
+    """ Finds the latitude and longitude of a search center.
 
-    radius_of_earth_miles = 3960
-    # radius_of_earth_km = 6373
+        Takes in search center postal code as a string and returns a tuple of
+        (latitude, longitude), or None if the postal code can't be found.
 
-    convert_to_radians = math.pi / 180
+    """
 
-    d_lat = convert_to_radians * (lat2 - lat1)
-    d_lon = convert_to_radians * (lng2 - lng1)
-    lat1_radians = convert_to_radians * lat1
-    lat2_radians = convert_to_radians * lat2
+    search_center_int = int(search_center_string)
+    print "\n\n\n\n**********SEARCH CENTER INT IS: %d*************\n\n\n\n" % search_center_int
+
+    # Check if zipcode is in the postal code index. Each process has its own
+    # index, so a zipcode another process added may only be in the database,
+    # in which case we add it to our index. If it's in neither, get lat and
+    # long from the offline geocoder and add it to the database (which also
+    # adds it to the index and clears out any saved distances it affects).
+    postalcode_index = get_postalcode_index()
+    search_center = postalcode_index.get(search_center_int)
+
+    if not search_center:
+        if PostalCode.query.get(search_center_int):
+            refresh_postalcode_index(search_center_int)
+        else:
+            make_postalcode(search_center_string)
 
-    a = math.sin(d_lat / 2)**2 + (math.cos(lat1_radians) * math.cos(lat2_radians) * math.sin(d_lon / 2)**2)
-    c = 2 * math.asin(math.sqrt(a))
+        search_center = postalcode_index.get(search_center_int)
 
-    d = radius_of_earth_miles * c
+    print "************Search center: \n\n\n\n %r \n\n\n\n**************" % (search_center,)
 
-    return d
+    return search_center
 
 
-def search_radius(search_center_string, postalcodes, radius):
+def search_radius(search_center_string, postalcodes, radius, strategy='cached'):
     """
         Finds zipcodes in the database that are within a search radius of a
         location.
 
-        This uses the python library geolocation-python, which uses the
-        GoogleMaps API.
+        Search centers that aren't in the PostalCodes table yet are looked up
+        with the offline geocoder (see geocoder.py).
 
         Takes in search center as a string, postalcodes as a list of tuples
         (because that is the format returned from the database), and search
         radius in miles as an integer. The function returns the list of
         postal codes in the given list that are within the given radius.
 
+        The strategy picks how nearby postal codes are found:
+            'cached': saved distances in the zip_distances table (default)
+            'bbox': lat/long bounding box query, then exact distances
+            'brute_force': look up each postal code in the list and check its
+                           distance one at a time. Slow, but simple enough to
+                           check the others against.
+
     """
 
     search_center_int = int(search_center_string)
-    print "\n\n\n\n**********SEARCH CENTER INT IS: %d*************\n\n\n\n" % search_center_int
+    search_center = get_search_center(search_center_string)
+
+    if not search_center:
+        return []
+
+    if strategy == 'cached':
+        # Distances from this center are saved in the zip_distances table the
+        # first time it's searched, so after that this is one indexed range
+        # scan.
+        nearby_postalcodes = get_nearby_postalcodes(search_center_int, radius)
+    elif strategy == 'bbox':
+        nearby_postalcodes = get_postalcodes_in_bounding_box(search_center[0],
+                                                             search_center[1],
+                                                             radius)
+    elif strategy == 'brute_force':
+        nearby_postalcodes = set()
+
+        for postalcode in postalcodes:
+            location = PostalCode.query.get(int(postalcode[0]))
+
+            if location:
+                distance = calc_Haversine_distance(search_center[0],
+                                                   search_center[1],
+                                                   location.latitude,
+                                                   location.longitude)
+                if distance <= radius:
+                    nearby_postalcodes.add(location.postalcode)
+    else:
+        raise ValueError("Unknown search strategy %r" % strategy)
 
-    # Check if zipcode is in database. If not, get lat and long from
-    # GoogleMaps and add it to the database.
+    # SQLite returns the distinct postal codes as a list of tuples. Pull out
+    # the postal code strings that are within the radius.
+    postalcodes_within_radius = []
 
-############# TODO: WHY IS THIS NOT MAKING A NEW POSTALCODE OBJECT????? #####
+    for postalcode in postalcodes:
+        if int(postalcode[0]) in nearby_postalcodes:
+            postalcodes_within_radius.append(postalcode[0])
 
-    search_center_obj = PostalCode.query.get(search_center_int)
+    return postalcodes_within_radius
 
-    if not search_center_obj:
-        make_postalcode(search_center_string)
-        search_center_obj = PostalCode.query.get(search_center_int)
 
-    print "************Search center object: \n\n\n\n %r \n\n\n\n**************" % search_center_obj
+def encode_cursor(row):
+    """ Makes a search results page cursor out of the last row on a page.
 
+        Takes in a row from search_products and returns a string of the form
+        "miles:prod_id". repr keeps every digit of the distance so the next
+        page starts exactly where this one stopped.
 
-    # SQLite returns the distinct postal codes as a list of tuples. Convert this
-    # to a list of postal code strings.
-    postalcodes_in_db = []
+    """
 
-    for postalcode in postalcodes:
-        postalcodes_in_db.append(postalcode[0])
+    return "%r:%d" % (row.miles, row.prod_id)
 
-    postalcodes_within_radius = []
-    lat1 = search_center_obj.latitude
-    lng1 = search_center_obj.longitude
 
-    for postalcode in postalcodes_in_db:
-        location = PostalCode.query.get(int(postalcode))
-        lat2 = location.latitude
-        lng2 = location.longitude
+def decode_cursor(cursor_string):
+    """ Takes in a cursor string from encode_cursor and returns a tuple of
+        (miles, prod_id). Raises ValueError if the cursor isn't valid.
+    """
 
-        distance = calc_Haversine_distance(lat1, lng1, lat2, lng2)
+    miles, prod_id = cursor_string.split(':')
 
-        if distance <= radius:
-            postalcodes_within_radius.append(postalcode)
+    return (float(miles), int(prod_id))
 
-    return postalcodes_within_radius
+
+def make_search_rows_query(search_center_int):
+    """ Makes the query for the columns shown on the search results page,
+        joining products to their brands, categories, owners, and the saved
+        distance from the owner's postal code to the search center. Callers
+        add their own filters.
+    """
+
+    query = db.session.query(Product.prod_id, Product.cat_id, Product.brand_id,
+                             Product.owner_user_id, Product.model,
+                             Product.image_url, Product.price_per_day,
+                             Brand.brand_name, Category.cat_name, User.city,
+                             ZipDistance.miles)
+
+    query = query.join(Brand, Product.brand_id == Brand.brand_id)
+    query = query.join(Category, Product.cat_id == Category.cat_id)
+
+    return join_search_area(query, search_center_int)
+
+
+def join_search_area(query, search_center_int):
+    """ Joins a products query to the products' owners and the saved distance
+        from each owner's postal code to the search center.
+    """
+
+    query = query.join(User, Product.owner_user_id == User.user_id)
+    # User postal codes are strings (to keep leading zeros) but postal codes
+    # in zip_distances are integers.
+    query = query.join(ZipDistance,
+                       and_(ZipDistance.center == search_center_int,
+                            ZipDistance.neighbor == cast(User.postalcode, Integer)))
+
+    return query
+
+
+def filter_available_nearby(query, radius, user_id, start_date, end_date):
+    """ Filters a query joined with join_search_area down to products within
+        the search radius that are listed by active owners other than the
+        logged in user (None means don't leave anyone out), and are available
+        and not booked for the search dates.
+    """
+
+    query = query.filter(ZipDistance.miles <= radius,
+                         User.active == True,
+                         Product.available == True,
+                         Product.avail_start_date <= start_date,
+                         Product.avail_end_date >= end_date)
+
+    # Leave out products that are booked for any of the search dates.
+    booked = overlapping_bookings(start_date, end_date).filter(
+        History.prod_id == Product.prod_id)
+    query = query.filter(~booked.exists())
+
+    if user_id is not None:
+        query = query.filter(User.user_id != user_id)
+
+    return query
+
+
+def filter_keywords(query, keywords):
+    """ Filters a products query down to products whose model, brand,
+        description, or condition match all the words in a keyword search
+        (e.g. "ultralight 2p tent"), using the products' full text search
+        documents and their GIN index. Empty keywords don't filter anything.
+    """
+
+    if not keywords:
+        return query
+
+    return query.filter(Product.search_vector.op('@@')(
+        func.plainto_tsquery('english', keywords)))
+
+
+def search_products(search_center_string, radius, user_id, start_date,
+                    end_date, category_id, brand_id, keywords=None,
+                    cursors=None, page_size=SEARCH_PAGE_SIZE):
+    """ Finds a page of products available for rent near a search center.
+
+        This does the same thing as chaining search_radius, get_users_in_area,
+        get_products_within_dates, filter_products, and categorize_products,
+        but joins products, brands, categories, users, and saved zipcode
+        distances in the database instead of loading every user in the area
+        and looping over their products in Python. There is one query per
+        category no matter how many owners are in range.
+
+        Results in each category are sorted closest first (then by prod_id)
+        and paged with a cursor instead of an offset, so each query only
+        fetches page_size + 1 rows however deep into the results we are.
+
+        Takes in search center as a string, radius in miles, the logged in
+        user's id (so we don't show the user his or her own stuff; None shows
+        everyone's), start and end datetimes, category and brand ids (-1 means
+        any), optional keywords, and optionally a dictionary of cat_id to the
+        (miles, prod_id) cursor from decode_cursor for categories that aren't
+        on their first page.
+
+        Returns two dictionaries with category names as keys:
+            inventory: lists of rows, each with prod_id, cat_id, brand_id,
+                       owner_user_id, model, image_url, price_per_day,
+                       brand_name, cat_name, city, and miles
+            next_cursors: cursor string for the next page, or None if this is
+                          the last page
+
+    """
+
+    search_center_int = int(search_center_string)
+
+    if not get_search_center(search_center_string):
+        raise ValueError("Could not find postal code %s" % search_center_string)
+
+    ensure_zip_distances(search_center_int, radius)
+
+    if cursors is None:
+        cursors = {}
+
+    query = make_search_rows_query(search_center_int)
+    query = filter_available_nearby(query, radius, user_id, start_date, end_date)
+    query = filter_keywords(query, keywords)
+
+    if brand_id > 0:
+        query = query.filter(Product.brand_id == brand_id)
+
+    # Every category we searched gets a key, even if nothing was found, so the
+    # results page can say so.
+    if category_id > 0:
+        search_categories = [Category.query.get(category_id)]
+    else:
+        search_categories = Category.query.all()
+
+    inventory = {}
+    next_cursors = {}
+
+    for category in search_categories:
+        category_query = query.filter(Product.cat_id == category.cat_id)
+
+        cursor = cursors.get(category.cat_id)
+
+        if cursor:
+            category_query = category_query.filter(
+                tuple_(ZipDistance.miles, Product.prod_id) > tuple_(*cursor))
+
+        category_query = category_query.order_by(ZipDistance.miles, Product.prod_id)
+
+        # Get one extra row so we know if there's another page.
+        rows = category_query.limit(page_size + 1).all()
+
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursors[category.cat_name] = encode_cursor(rows[-1])
+        else:
+            next_cursors[category.cat_name] = None
+
+        inventory[category.cat_name] = rows
+
+    return inventory, next_cursors
+
+
+def count_search_facets(search_center_string, radius, user_id, start_date,
+                        end_date, category_id, brand_id, keywords=None):
+    """ Counts how many products a search would find in each category and for
+        each brand, so the drop downs on the results page can show which
+        filters would find something.
+
+        This is a single GROUP BY query on (cat_id, brand_id) with the same
+        location and date filters as search_products. The category counts
+        respect the brand filter, and the brand counts respect the category
+        filter, so each count is what you'd get by changing just that one
+        drop down.
+
+        Takes in the same arguments as search_products and returns two
+        dictionaries: cat_id to count and brand_id to count. Categories and
+        brands with nothing are left out.
+
+    """
+
+    search_center_int = int(search_center_string)
+    ensure_zip_distances(search_center_int, radius)
+
+    query = db.session.query(Product.cat_id, Product.brand_id,
+                             func.count(Product.prod_id))
+    query = join_search_area(query, search_center_int)
+    query = filter_available_nearby(query, radius, user_id, start_date, end_date)
+    query = filter_keywords(query, keywords)
+    query = query.group_by(Product.cat_id, Product.brand_id)
+
+    category_counts = {}
+    brand_counts = {}
+
+    for cat_id, product_brand_id, count in query:
+        if brand_id < 0 or product_brand_id == brand_id:
+            category_counts[cat_id] = category_counts.get(cat_id, 0) + count
+
+        if category_id < 0 or cat_id == category_id:
+            brand_counts[product_brand_id] = brand_counts.get(product_brand_id, 0) + count
+
+    return category_counts, brand_counts
+
+
+def cached_search_products(search_center_string, radius, user_id, start_date,
+                           end_date, category_id, brand_id, keywords=None,
+                           cursors=None, page_size=SEARCH_PAGE_SIZE):
+    """ Same as search_products, but checks the search results cache first
+        (see search_cache.py).
+
+        Cached pages are shared by everyone running the same search, so they
+        include every owner's products and the logged in user's own products
+        are taken out afterwards. The cache only keeps product ids, so a hit
+        is one query to get the rows back. That query checks availability,
+        owners, dates, and bookings again, in case something changed without
+        invalidating the cache (e.g. a booking made by another process).
+
+    """
+
+    search_center_int = int(search_center_string)
+
+    if cursors is None:
+        cursors = {}
+
+    # Keyword searches match the same whatever the case or extra spaces.
+    if keywords:
+        keywords = ' '.join(keywords.lower().split())
+
+    key = (search_center_int, radius, start_date.date(), end_date.date(),
+           category_id, brand_id, keywords or None,
+           tuple(sorted(cursors.items())), page_size)
+
+    cached = search_result_cache.get(key)
+
+    if cached is None:
+        inventory, next_cursors = search_products(search_center_string, radius,
+                                                  None, start_date, end_date,
+                                                  category_id, brand_id,
+                                                  keywords=keywords,
+                                                  cursors=cursors,
+                                                  page_size=page_size)
+
+        prod_ids_by_category = {}
+        all_prod_ids = []
+
+        for category_name, rows in inventory.iteritems():
+            prod_ids_by_category[category_name] = [row.prod_id for row in rows]
+            all_prod_ids.extend(prod_ids_by_category[category_name])
+
+        lat, lng = get_search_center(search_center_string)
+        search_result_cache.put(key, (prod_ids_by_category, next_cursors),
+                                all_prod_ids, lat, lng, radius)
+    else:
+        prod_ids_by_category, next_cursors = cached
+
+        all_prod_ids = []
+
+        for prod_ids in prod_ids_by_category.itervalues():
+            all_prod_ids.extend(prod_ids)
+
+        rows_by_id = {}
+
+        if all_prod_ids:
+            # The rows query joins zip_distances for each product's distance,
+            # and a new postal code nearby may have thrown those away.
+            ensure_zip_distances(search_center_int, radius)
+
+            query = make_search_rows_query(search_center_int)
+            query = filter_available_nearby(query, radius, None, start_date, end_date)
+            query = query.filter(Product.prod_id.in_(all_prod_ids))
+
+            for row in query:
+                rows_by_id[row.prod_id] = row
+
+        inventory = {}
+
+        for category_name, prod_ids in prod_ids_by_category.iteritems():
+            inventory[category_name] = [rows_by_id[prod_id] for prod_id in prod_ids
+                                        if prod_id in rows_by_id]
+
+    for category_name, rows in inventory.iteritems():
+        inventory[category_name] = [row for row in rows
+                                    if row.owner_user_id != user_id]
+
+    return inventory, next_cursors
 
 
 def get_users_in_area(postal_codes, user_id):
@@ -102,7 +427,10 @@ def get_users_in_area(postal_codes, user_id):
 
     """
 
-    users_in_area = User.query.filter(User.postalcode.in_(postal_codes)).all()
+    # Load their products too, since get_products_within_dates looks at all
+    # of them.
+    users_in_area = User.query.filter(User.postalcode.in_(postal_codes)).options(
+        *for_search_cards()).all()
     logged_in_user = User.query.get(user_id)
 
     if logged_in_user in users_in_area:
@@ -144,7 +472,8 @@ def get_products_within_dates(start_date, end_date, users):
 
         Takes in list of users and returns a list of products
         those users have available for rent within the specified start and
-        end dates (inclusive).
+        end dates (inclusive). Products booked for any of those dates are left
+        out, but products booked for other dates are included.
 
     """
 
@@ -156,7 +485,11 @@ def get_products_within_dates(start_date, end_date, users):
                 if product.available and (product.avail_start_date <= start_date) and (product.avail_end_date >= end_date):
                     available_products.append(product)
 
-    return available_products
+    booked_prod_ids = find_booked_products([product.prod_id for product in available_products],
+                                           start_date, end_date)
+
+    return [product for product in available_products
+            if product.prod_id not in booked_prod_ids]
 
 
 def categorize_products(categories, products):
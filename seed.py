@@ -3,9 +3,274 @@ from model import FillType, Gender, SleepingBag, PadType, SleepingPad
 from model import History, Rating, PostalCode
 from model import connect_to_db, db
 from server import app
+from postalcode_index import clear_postalcode_index
+from autocomplete import clear_autocomplete_indexes
+from reference_data import clear_reference_data
+from search_cache import search_result_cache
+from make_update_helpers import update_search_vector
+from distance_helpers import invalidate_zip_distances_many
+from rating_helpers import rebuild_rating_summaries
+from sqlalchemy import bindparam, inspect, select
+from collections import OrderedDict
 from datetime import datetime
+import time
+import sys
 import os
 
+# Rows sent to the database per INSERT by BulkInserter. Override with
+# SEED_BATCH_SIZE, e.g. SEED_BATCH_SIZE=1000 python seed.py
+BATCH_SIZE = int(os.environ.get('SEED_BATCH_SIZE', 5000))
+
+
+class BulkInserter(object):
+    """ Inserts rows into a model's table in batches with one Core
+        executemany per batch, instead of making an ORM object for each row.
+        The load_* functions stream their files through one of these, so only
+        one batch is ever in memory.
+
+        Column defaults still apply, but ORM-only things (relationships,
+        session identity map) don't, so use this for seeding, not in the app.
+    """
+
+    def __init__(self, model, batch_size=None):
+        self.table = model.__table__
+        self.batch_size = batch_size or BATCH_SIZE
+        self.batch = []
+        self.count = 0
+
+    def add(self, **values):
+        """Queues one row, and sends the batch if it's full."""
+
+        self.batch.append(values)
+
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Sends the queued rows to the database."""
+
+        if self.batch:
+            db.session.execute(self.table.insert(), self.batch)
+            self.count += len(self.batch)
+            self.batch = []
+
+    def finish(self):
+        """Sends any rows left and commits. Returns how many rows were added."""
+
+        self.flush()
+        db.session.commit()
+
+        return self.count
+
+
+def copy_file(model, columns, filename, sep='|'):
+    """ Loads a delimited file straight into model's table with Postgres
+        COPY, which is much faster than INSERTs for big files. The file's
+        fields must be in the same order as columns. Returns how many rows
+        were loaded, or None if the database isn't Postgres (use
+        BulkInserter instead).
+    """
+
+    connection = db.session.connection()
+
+    if connection.dialect.name != 'postgresql':
+        return None
+
+    sql = "COPY %s (%s) FROM STDIN WITH (FORMAT text, DELIMITER '%s')" % (
+        model.__tablename__, ', '.join(columns), sep)
+
+    # COPY goes through the session's connection, so it's in the same
+    # transaction as everything else and commits with it.
+    cursor = connection.connection.cursor()
+
+    try:
+        with open(filename) as copy_input:
+            cursor.copy_expert(sql, copy_input)
+
+        count = cursor.rowcount
+    finally:
+        cursor.close()
+
+    db.session.commit()
+
+    return count
+
+
+# Column each table is matched on when syncing. Seed files don't have ids,
+# so tables with serial ids are matched on a natural unique key instead, and
+# new rows get the next id from the sequence. Tables that aren't here
+# (products and their subsets, histories, ratings) can only be matched on
+# ids from file position, which can land on rows the app made, so they
+# can't be synced.
+SYNC_KEYS = {'regions': 'abbr',
+             'bestuses': 'use_name',
+             'categories': 'cat_name',
+             'brands': 'brand_name',
+             'users': 'email',
+             'filltypes': 'fill_code',
+             'genders': 'gender_code',
+             'padtypes': 'pad_type_code',
+             'postalcodes': 'postalcode',
+             }
+
+# Tables the app adds rows to, so a sync can't delete rows that aren't in
+# the seed file. (The app adds postal codes too, but those are geocoder
+# results that are added again the next time they're searched for.)
+APP_TABLES = set(['brands', 'users'])
+
+
+class SyncWriter(object):
+    """ Same add/finish interface as BulkInserter, but instead of inserting
+        every row it makes the table match the rows it's given: rows that
+        aren't in the table are inserted, rows that are different are
+        updated, and unchanged rows are left alone. If delete_missing is
+        set, rows in the table that weren't given are deleted. Changes are
+        sent in batches of BATCH_SIZE and committed together by finish.
+
+        Rows are matched on the table's column in SYNC_KEYS. Raises
+        ValueError for a table that can't be synced, or can't have rows
+        deleted.
+
+    """
+
+    def __init__(self, model, delete_missing=False, batch_size=None):
+        self.table = model.__table__
+
+        if self.table.name not in SYNC_KEYS:
+            raise ValueError("%s can't be synced, since it has no key to match "
+                             "rows on." % self.table.name)
+
+        if delete_missing and self.table.name in APP_TABLES:
+            raise ValueError("Can't delete from %s, since the app adds rows to "
+                             "it." % self.table.name)
+
+        self.key = self.table.c[SYNC_KEYS[self.table.name]]
+        self.delete_missing = delete_missing
+        self.batch_size = batch_size or BATCH_SIZE
+
+        self.inserts = BulkInserter(model, self.batch_size)
+        self.updates = []
+        self.num_rows = 0
+        self.counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        # Key to the values given for every row inserted or updated.
+        self.changed = {}
+
+        # Key to row for everything in the table now. Rows are removed as
+        # they're matched, so what's left at the end is missing from the
+        # file.
+        self.existing = dict((row[self.key.name], row)
+                             for row in db.session.execute(select([self.table])))
+
+    def add(self, **values):
+        """Compares one row with the table, and queues an insert or update."""
+
+        self.num_rows += 1
+
+        key = coerce_value(self.key, values[self.key.key])
+        current = self.existing.pop(key, None)
+
+        if current is None:
+            self.inserts.add(**values)
+            self.counts['inserted'] += 1
+            self.changed[key] = values
+            return
+
+        for column_key, value in values.iteritems():
+            column = self.table.c[column_key]
+
+            if coerce_value(column, value) != current[column.name]:
+                break
+        else:
+            self.counts['unchanged'] += 1
+            return
+
+        values['sync_key'] = key
+        self.updates.append(values)
+        self.counts['updated'] += 1
+        self.changed[key] = values
+
+        if len(self.updates) >= self.batch_size:
+            self.flush_updates()
+
+    def flush_updates(self):
+        """Sends the queued updates to the database."""
+
+        if self.updates:
+            update = self.table.update().where(self.key == bindparam('sync_key'))
+            db.session.execute(update, self.updates)
+            self.updates = []
+
+    def changes(self):
+        """ Returns a dictionary of key to the values given for every row
+            that was inserted or updated, plus key to None for every row
+            finish will delete. Call it after the last add.
+        """
+
+        changes = dict(self.changed)
+
+        if self.delete_missing:
+            for key in self.existing:
+                changes[key] = None
+
+        return changes
+
+    def finish(self):
+        """ Sends the remaining inserts and updates, deletes missing rows if
+            delete_missing is set, and commits. Prints what changed and
+            returns how many rows were given.
+        """
+
+        self.inserts.flush()
+        self.flush_updates()
+
+        if self.delete_missing:
+            missing = self.existing.keys()
+
+            for start in range(0, len(missing), self.batch_size):
+                batch = missing[start:start + self.batch_size]
+                db.session.execute(self.table.delete().where(self.key.in_(batch)))
+
+            self.counts['deleted'] = len(missing)
+
+        db.session.commit()
+
+        print "  %(inserted)d inserted, %(updated)d updated, %(deleted)d deleted, " \
+              "%(unchanged)d unchanged" % self.counts
+
+        return self.num_rows
+
+
+def coerce_value(column, value):
+    """ Converts a value parsed from a seed file to what the database gives
+        back for column, so SyncWriter can tell if a row changed (e.g. "1"
+        to 1, or "0" to False for a boolean).
+    """
+
+    if value is None:
+        return None
+
+    python_type = column.type.python_type
+
+    if python_type is bool and isinstance(value, basestring):
+        return value.strip().lower() in ('1', 't', 'true', 'yes')
+
+    if python_type in (int, float) and isinstance(value, basestring):
+        return python_type(value)
+
+    return value
+
+
+def table_writer(model, sync=False, delete_missing=False):
+    """ Returns what a load_* function adds its rows to: a BulkInserter for a
+        fresh load, or a SyncWriter to update a table that's already loaded.
+    """
+
+    if sync:
+        return SyncWriter(model, delete_missing)
+
+    return BulkInserter(model)
+
+
 def clear_data():
     meta = db.metadata
     for table in reversed(meta.sorted_tables):
@@ -17,30 +282,39 @@ def clear_data():
         db.engine.execute('DROP TABLE ' + table.name + ' CASCADE')
         db.session.commit()
 
+    # The postal code index, autocomplete indexes, reference data, and cached
+    # search results come from the tables we just dropped.
+    clear_postalcode_index()
+    clear_autocomplete_indexes()
+    clear_reference_data()
+    search_result_cache.clear()
+
 
-def load_regions():
+def load_regions(sync=False, delete_missing=False):
     """Load regions, i.e. states, for user addresses"""
 
     print "Regions"
     # Region.query.delete()
 
+    rows = table_writer(Region, sync, delete_missing)
+
     for row in open("data/regionsdata"):
         row = row.strip()
         abbr, full = row.split("|")
 
-        a = Region(abbr=abbr, full=full)
+        rows.add(abbr=abbr, full=full)
 
-        db.session.add(a)
-
-    db.session.commit()
+    rows.finish()
 
 
-def load_users():
+def load_users(sync=False, delete_missing=False):
     """Load user data"""
 
     print "Users"
     # User.query.delete()
 
+    rows = table_writer(User, sync, delete_missing)
+
     for row in open("data/customerdata"):
         row = row.strip()
         row = row.split("|")
@@ -57,69 +331,69 @@ def load_users():
         pword = row[8]
         pic = row[9]
 
-        a = User(fname=firstn, lname=lastn, street=staddress,
+        rows.add(fname=firstn, lname=lastn, street=staddress,
                  city=cty, region_id=region, postalcode=zcode, phone=phn,
                  email=login, password=pword, profile_pic_url=pic)
 
-        db.session.add(a)
-
-    db.session.commit()
+    rows.finish()
 
 
-def load_bestuses():
+def load_bestuses(sync=False, delete_missing=False):
     """Load best use categories"""
 
     print "BestUses"
     # BestUse.query.delete()
 
+    rows = table_writer(BestUse, sync, delete_missing)
+
     for row in open("data/bestusesdata"):
         use = row.strip()
 
-        a = BestUse(use_name=use)
+        rows.add(use_name=use)
 
-        db.session.add(a)
-
-    db.session.commit()
+    rows.finish()
 
 
-def load_categories():
+def load_categories(sync=False, delete_missing=False):
     """Load product categories"""
 
     print "Categories"
     # Category.query.delete()
 
+    rows = table_writer(Category, sync, delete_missing)
+
     for row in open("data/categoriesdata"):
         name = row.strip()
 
-        a = Category(cat_name=name)
+        rows.add(cat_name=name)
 
-        db.session.add(a)
-
-    db.session.commit()
+    rows.finish()
 
 
-def load_brands():
+def load_brands(sync=False, delete_missing=False):
     """Load brand names"""
 
     print "Brands"
     # Brand.query.delete()
 
+    rows = table_writer(Brand, sync, delete_missing)
+
     for row in open("data/brandsdata"):
         name = row.strip()
 
-        a = Brand(brand_name=name)
-
-        db.session.add(a)
+        rows.add(brand_name=name)
 
-    db.session.commit()
+    rows.finish()
 
 
-def load_products():
+def load_products(sync=False, delete_missing=False):
     """Load products data"""
 
     print "Products"
     # Product.query.delete()
 
+    rows = table_writer(Product, sync, delete_missing)
+
     for row in open("data/productsdata"):
         row = row.strip()
         row = row.split("|")
@@ -141,22 +415,25 @@ def load_products():
         date1 = datetime.strptime(date1, "%Y-%m-%d")
         date2 = datetime.strptime(date2, "%Y-%m-%d")
 
-        a = Product(cat_id=category, brand_id=brand, owner_user_id=owner,
-                    model=mname, condition=con, description=desc,
-                    avail_start_date=date1, avail_end_date=date2,
-                    price_per_day=dollarz, image_url=image, available=avail)
+        rows.add(cat_id=category, brand_id=brand, owner_user_id=owner,
+                 model=mname, condition=con, description=desc,
+                 avail_start_date=date1, avail_end_date=date2,
+                 price_per_day=dollarz, image_url=image, available=avail)
 
-        db.session.add(a)
+    rows.finish()
 
-    db.session.commit()
+    # Build the keyword search documents for the products we just loaded.
+    update_search_vector()
 
 
-def load_tents():
+def load_tents(sync=False, delete_missing=False):
     """Load tents data"""
 
     print "Tents"
     # Tent.query.delete()
 
+    rows = table_writer(Tent, sync, delete_missing)
+
     for row in open("data/tentsdata"):
         row = row.strip()
         row = row.split("|")
@@ -171,55 +448,55 @@ def load_tents():
         doors = int(row[7])
         poles = int(row[8])
 
-        a = Tent(prod_id=product, use_id=use, sleep_capacity=capacity,
+        rows.add(prod_id=product, use_id=use, sleep_capacity=capacity,
                  seasons=num_sea, min_trail_weight=weight, floor_width=width,
                  floor_length=length, num_doors=doors, num_poles=poles)
 
-        db.session.add(a)
+    rows.finish()
 
-    db.session.commit()
 
-
-def load_filltypes():
+def load_filltypes(sync=False, delete_missing=False):
     """Load sleeping bag fill types"""
 
     print "Fill Types"
     # FillType.query.delete()
 
+    rows = table_writer(FillType, sync, delete_missing)
+
     for row in open("data/filltypesdata"):
         row = row.strip()
         code, name = row.split("|")
 
-        a = FillType(fill_code=code, fill_name=name)
+        rows.add(fill_code=code, fill_name=name)
 
-        db.session.add(a)
-
-    db.session.commit()
+    rows.finish()
 
 
-def load_gendertypes():
+def load_gendertypes(sync=False, delete_missing=False):
     """Load gender types"""
 
     print "Gender Types"
     # Gender.query.delete()
 
+    rows = table_writer(Gender, sync, delete_missing)
+
     for row in open("data/gendersdata"):
         row = row.strip()
         code, name = row.split("|")
 
-        a = Gender(gender_code=code, gender_name=name)
-
-        db.session.add(a)
+        rows.add(gender_code=code, gender_name=name)
 
-    db.session.commit()
+    rows.finish()
 
 
-def load_sleepingbags():
+def load_sleepingbags(sync=False, delete_missing=False):
     """Load sleeping bags data"""
 
     print "Sleeping Bags"
     # SleepingBag.query.delete()
 
+    rows = table_writer(SleepingBag, sync, delete_missing)
+
     for row in open("data/sleepingbagsdata"):
         row = row.strip()
         row = row.split("|")
@@ -231,37 +508,37 @@ def load_sleepingbags():
         lgth = int(row[4])
         ger = row[5]
 
-        a = SleepingBag(prod_id=product, fill_code=fill, temp_rating=temp,
-                        weight=wt, length=lgth, gender_code=ger)
+        rows.add(prod_id=product, fill_code=fill, temp_rating=temp,
+                 weight=wt, length=lgth, gender_code=ger)
 
-        db.session.add(a)
+    rows.finish()
 
-    db.session.commit()
 
-
-def load_padtypes():
+def load_padtypes(sync=False, delete_missing=False):
     """Load pad types"""
 
     print "Pad Types"
     # PadType.query.delete()
 
+    rows = table_writer(PadType, sync, delete_missing)
+
     for row in open("data/padtypesdata"):
         row = row.strip()
         code, name = row.split("|")
 
-        a = PadType(pad_type_code=code, pad_type_name=name)
+        rows.add(pad_type_code=code, pad_type_name=name)
 
-        db.session.add(a)
-
-    db.session.commit()
+    rows.finish()
 
 
-def load_sleepingpads():
+def load_sleepingpads(sync=False, delete_missing=False):
     """Load sleeping pads data"""
 
     print "Sleeping Pads"
     # SleepingPad.query.delete()
 
+    rows = table_writer(SleepingPad, sync, delete_missing)
+
     for row in open("data/sleepingpadsdata"):
         row = row.strip()
         row = row.split("|")
@@ -274,20 +551,20 @@ def load_sleepingpads():
         wt = int(row[5])
         wdth = int(row[6])
 
-        a = SleepingPad(prod_id=product, type_code=pad_type, use_id=use,
-                        r_value=rval, length=lgth, weight=wt, width=wdth)
+        rows.add(prod_id=product, type_code=pad_type, use_id=use,
+                 r_value=rval, length=lgth, weight=wt, width=wdth)
 
-        db.session.add(a)
+    rows.finish()
 
-    db.session.commit()
 
-
-def load_histories():
+def load_histories(sync=False, delete_missing=False):
     """Load history data"""
 
     print "Histories"
     # History.query.delete()
 
+    rows = table_writer(History, sync, delete_missing)
+
     for row in open("data/historiesdata"):
         row = row.strip()
         row = row.split("|")
@@ -316,24 +593,27 @@ def load_histories():
         rental_start_date = datetime.strptime(rental_start_date, "%Y-%m-%d")
         rental_end_date = datetime.strptime(rental_end_date, "%Y-%m-%d")
 
-        a = History(prod_id=product, renter_user_id=renter,
-                    rental_submission_date=rental_submit_date,
-                    start_date=rental_start_date,
-                    end_date=rental_end_date, total_cost=cost,
-                    owner_rating_id=owner_rate,
-                    renter_rating_id=renter_rate, prod_rating_id=prod_rate)
+        rows.add(prod_id=product, renter_user_id=renter,
+                 rental_submission_date=rental_submit_date,
+                 start_date=rental_start_date,
+                 end_date=rental_end_date, total_cost=cost,
+                 owner_rating_id=owner_rate,
+                 renter_rating_id=renter_rate, prod_rating_id=prod_rate)
 
-        db.session.add(a)
+    rows.finish()
 
-    db.session.commit()
+    # Count the ratings on the histories we just loaded.
+    rebuild_rating_summaries()
 
 
-def load_ratings():
+def load_ratings(sync=False, delete_missing=False):
     """Load ratings"""
 
     print "Ratings"
     # Rating.query.delete()
 
+    rows = table_writer(Rating, sync, delete_missing)
+
     for row in open("data/ratingsdata"):
         row = row.strip()
         row = row.split("|")
@@ -341,77 +621,190 @@ def load_ratings():
         num_stars = int(row[0])
         text_comments = row[1]
 
-        a = Rating(stars=num_stars, comments=text_comments)
+        rows.add(stars=num_stars, comments=text_comments)
 
-        db.session.add(a)
+    rows.finish()
 
-    db.session.commit()
 
-
-def load_postalcodes():
-    """Load postalcode lat and longs so can do distance search (as the bird flies)
-        without GoogleMaps.
+def load_postalcode_file(filename, sync=False, delete_missing=False):
+    """ Loads a zipcode|latitude|longitude file into postalcodes. Uses COPY
+        on Postgres (the full file loads in about a second), or batched
+        INSERTs on anything else. With sync, only the differences are
+        applied instead (see SyncWriter).
     """
 
     print "PostalCodes"
     # PostalCodes.query.delete()
 
-    for row in open('data/cityzip_nodupes'):
-        row.strip()
-        temp = row.split('|')
-        zipcode = int(temp[0])
-        lat = float(temp[1])
-        longide = float(temp[2])
+    start = time.time()
+    count = None
 
-        a = PostalCode(postalcode=zipcode, latitude=lat, longitude=longide)
+    if not sync:
+        count = copy_file(PostalCode, ['postalcode', 'latitude', 'longitude'],
+                          filename)
 
-        db.session.add(a)
+    if count is None:
+        rows = table_writer(PostalCode, sync, delete_missing)
 
-    db.session.commit()
+        for row in open(filename):
+            temp = row.strip().split('|')
+            zipcode = int(temp[0])
+            lat = float(temp[1])
+            lng = float(temp[2])
 
+            rows.add(postalcode=zipcode, latitude=lat, longitude=lng)
 
-def load_test_postalcodes():
+        if sync:
+            # Throw away saved search distances for centers near postal codes
+            # that were added, moved, or deleted, in the same transaction as
+            # the sync (zip_distances rows would stop the deletes). They're
+            # refilled by the next search from each center.
+            changes = rows.changes()
+
+            if changes:
+                locations = dict((zipcode, (values['latitude'], values['longitude']))
+                                 for zipcode, values in changes.iteritems() if values)
+                invalidate_zip_distances_many(changes.keys(), locations)
+
+        count = rows.finish()
+
+    print "Loaded %d postal codes in %.2f seconds" % (count, time.time() - start)
+
+
+def load_postalcodes(sync=False, delete_missing=False):
     """Load postalcode lat and longs so can do distance search (as the bird flies)
         without GoogleMaps.
     """
 
-    print "PostalCodes"
-    # PostalCodes.query.delete()
+    load_postalcode_file('data/cityzip_nodupes', sync, delete_missing)
+
+
+def load_test_postalcodes(sync=False, delete_missing=False):
+    """Load the few postalcodes the tests use (much faster than all of them)."""
+
+    load_postalcode_file('data/cityzip_fortests', sync, delete_missing)
+
+
+# Every dataset, in the order they have to be loaded in. python seed.py loads
+# all but postalcodes (the full set) into empty tables.
+SEED_DATASETS = OrderedDict([('regions', load_regions),
+                             ('users', load_users),
+                             ('bestuses', load_bestuses),
+                             ('categories', load_categories),
+                             ('brands', load_brands),
+                             ('products', load_products),
+                             ('tents', load_tents),
+                             ('filltypes', load_filltypes),
+                             ('gendertypes', load_gendertypes),
+                             ('sleepingbags', load_sleepingbags),
+                             ('padtypes', load_padtypes),
+                             ('sleepingpads', load_sleepingpads),
+                             ('ratings', load_ratings),
+                             ('histories', load_histories),
+                             ('test_postalcodes', load_test_postalcodes),
+                             ('postalcodes', load_postalcodes),
+                             ])
+
+DEFAULT_DATASETS = [name for name in SEED_DATASETS if name != 'postalcodes']
+
+# Datasets that can be synced, and the table each one loads.
+SYNC_DATASETS = OrderedDict([('regions', 'regions'),
+                             ('users', 'users'),
+                             ('bestuses', 'bestuses'),
+                             ('categories', 'categories'),
+                             ('brands', 'brands'),
+                             ('filltypes', 'filltypes'),
+                             ('gendertypes', 'genders'),
+                             ('padtypes', 'padtypes'),
+                             ('test_postalcodes', 'postalcodes'),
+                             ('postalcodes', 'postalcodes'),
+                             ])
+
+
+def check_schema():
+    """ Makes any missing tables, and raises RuntimeError if an existing
+        table is missing columns or indexes the models have. db.create_all
+        doesn't change tables that already exist, so those need a migration
+        (e.g. products.search_vector and ix_products_search_vector).
+    """
 
-    for row in open('data/cityzip_fortests'):
-        row.strip()
-        temp = row.split('|')
-        zipcode = int(temp[0])
-        lat = float(temp[1])
-        lng = float(temp[2])
+    db.create_all()
 
-        a = PostalCode(postalcode=zipcode, latitude=lat, longitude=lng)
+    inspector = inspect(db.engine)
+    missing = []
 
-        db.session.add(a)
+    for table in db.metadata.sorted_tables:
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        indexes = set(index['name'] for index in inspector.get_indexes(table.name))
 
-    db.session.commit()
+        missing.extend('column %s.%s' % (table.name, column.name)
+                       for column in table.columns if column.name not in columns)
+        missing.extend('index %s' % index.name
+                       for index in table.indexes if index.name not in indexes)
+
+    if missing:
+        raise RuntimeError("The database is missing %s. Migrate it (or drop it "
+                           "and run python seed.py) before syncing." % ', '.join(missing))
+
+
+def sync_data(names=None, delete_missing=False):
+    """ Brings datasets (default: the ones in DEFAULT_DATASETS that can be
+        synced) in an existing database up to date with their seed files,
+        without dropping anything. With delete_missing, rows that aren't in
+        the files are deleted too, which isn't allowed for tables the app
+        adds rows to (APP_TABLES).
+
+        Other processes' caches of these tables (postal code index,
+        autocomplete, reference data) catch up when they expire or the
+        process restarts.
+
+    """
+
+    names = names or [name for name in DEFAULT_DATASETS if name in SYNC_DATASETS]
+
+    # Check everything before changing anything.
+    for name in names:
+        if name not in SEED_DATASETS:
+            raise ValueError("Unknown dataset %r. Use some of %s." % (
+                name, ', '.join(SYNC_DATASETS)))
+
+        if name not in SYNC_DATASETS:
+            raise ValueError("%s can't be synced, since it has no key to match "
+                             "rows on. Use some of %s." % (name, ', '.join(SYNC_DATASETS)))
+
+        if delete_missing and SYNC_DATASETS[name] in APP_TABLES:
+            raise ValueError("Can't use --delete with %s, since the app adds rows "
+                             "to it." % name)
+
+    check_schema()
+
+    for name in names:
+        SEED_DATASETS[name](sync=True, delete_missing=delete_missing)
+
+    # This process's caches of the tables we changed.
+    clear_postalcode_index()
+    clear_autocomplete_indexes()
+    clear_reference_data()
+    search_result_cache.clear()
 
 
 if __name__ == "__main__":
+    # python seed.py drops every table and loads the seed files.
+    # python seed.py sync [--delete] [dataset ...] updates the tables in place.
     connect_to_db(app)
 
-    clear_data()
-    # In case tables haven't been created, create them
-    db.create_all()
+    args = sys.argv[1:]
+
+    if args and args[0] == 'sync':
+        args = args[1:]
+        delete_missing = '--delete' in args
+
+        sync_data([name for name in args if name != '--delete'], delete_missing)
+    else:
+        clear_data()
+        # In case tables haven't been created, create them
+        db.create_all()
 
-    # Seed data
-    load_regions()
-    load_users()
-    load_bestuses()
-    load_categories()
-    load_brands()
-    load_products()
-    load_tents()
-    load_filltypes()
-    load_gendertypes()
-    load_sleepingbags()
-    load_padtypes()
-    load_sleepingpads()
-    load_ratings()
-    load_histories()
-    load_test_postalcodes()
+        # Seed data
+        for name in DEFAULT_DATASETS:
+            SEED_DATASETS[name]()
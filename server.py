@@ -2,21 +2,34 @@
 
 from jinja2 import StrictUndefined
 from flask import Flask, render_template, redirect, request, flash, session
+from flask import jsonify
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.orm.exc import NoResultFound
 from datetime import datetime, timedelta
-from model import connect_to_db, db, User, Region, Product, Tent, SleepingBag
-from model import SleepingPad, BestUse, Brand, History, Category, Rating, Gender
-from model import FillType, PadType
+from model import connect_to_db, db, User, Product, History, Rating
 from make_update_helpers import make_user, check_brand, make_parent_product
 from make_update_helpers import make_tent, make_sleeping_bag, make_sleeping_pad
 from make_update_helpers import update_parent_product, update_tent
 from make_update_helpers import update_sleeping_bag, update_sleeping_pad
-from make_update_helpers import calc_avg_star_rating, reverse_merge_sort_histories
-from make_update_helpers import format_phone_number
-from search_helpers import search_radius, get_users_in_area, filter_products
-from search_helpers import get_products_within_dates, categorize_products
+from make_update_helpers import format_phone_number, update_search_vector
+from search_helpers import cached_search_products, get_search_center, decode_cursor
+from search_helpers import count_search_facets
 from search_helpers import calc_default_dates, convert_string_to_datetime
+from geocoder import geocode_cache
+from search_cache import search_result_cache
+from booking_helpers import book_product, get_owner_histories, get_renter_histories
+from booking_helpers import decode_history_cursor
+from search_cache import invalidate_search_results_for_products
+from search_cache import invalidate_search_results_near
+from autocomplete import get_brand_index, get_model_index
+from rating_helpers import update_rating_summary, rating_subject_id
+from rating_helpers import get_rating_summary, get_rating_summaries
+from loading_profiles import for_account_inventory, for_product_detail
+from loading_profiles import for_rating_rows
+from query_stats import install_query_stats
+from db_config import pool_metrics
+from reference_data import get_reference_data
+from urllib import urlencode
 import os
 
 app = Flask(__name__)
@@ -24,6 +37,10 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "ABC")
 app.jinja_env.undefined = StrictUndefined
 
+# Count each request's SQL statements and report them in the response headers
+# and the log (see query_stats.py).
+install_query_stats(app)
+
 
 ######################## User stuff ###################################
 @app.route('/')
@@ -107,8 +124,10 @@ def enter_site():
     customer = User.query.filter(User.email == session['user']).one()
     dates = calc_default_dates(7)
 
-    categories = Category.query.all()
-    brands = Brand.query.all()
+    # Drop down data comes from the reference data cache, not the database.
+    reference = get_reference_data()
+    categories = reference.categories
+    brands = reference.brands
 
     return render_template("success.html", user=customer,
                            today=dates['today_string'],
@@ -129,7 +148,7 @@ def show_account():
     # To display the state as a name, we need to get the name associated with
     # the region ID.
     state_id = customer.region_id
-    st = Region.query.get(state_id).full
+    st = get_reference_data().regions_by_id[state_id].full
 
     # Put parens and a dash in the phone number to display.
     prettify_phone = format_phone_number(customer.phone)
@@ -143,55 +162,65 @@ def show_account():
     next30 = today_date + timedelta(days=30)
 
     # Get product inventory for this user, then split into those that are
-    # currently available (and will show up in search results) and not
-    # available (user has to actively relist if he or she wants it show up
-    # in search results).
-    products_all = Product.query.filter(Product.owner_user_id == customer.user_id).all()
+    # currently available (and will show up in search results for dates they
+    # aren't booked) and delisted (user has to actively relist if he or she
+    # wants it show up in search results). The loading profile gets the brands
+    # and categories the template shows in the same query.
+    products_all = Product.query.filter(Product.owner_user_id == customer.user_id).options(
+        *for_account_inventory()).all()
     products_avail = []
     products_out = []
 
-    product_history_lists = []
-    product_histories = []
-
     # Separate inventory into those that are available and those that are not.
     for product in products_all:
-        if product.histories:
-            product_history_lists.append(product.histories)
         if product.available:
             products_avail.append(product)
         else:
             products_out.append(product)
 
-    # Pull out individual histories from the list of histories associated with
-    # each product.
-    for history_list in product_history_lists:
-        for history in history_list:
-            product_histories.append(history)
-
-    # Use merge sort helper function from make_update_helpers so can list
-    # histories in descending order based on rental submission date. We want to
-    # show the most recently requested rental first.
-    if len(product_histories) > 1:
-        desc_date_histories = reverse_merge_sort_histories(product_histories)
-    else:
-        desc_date_histories = product_histories
-
-    # Moving on to user's history for renting stuff, get all the histories where
-    # this user is the renter.
-    rentals = History.query.filter(History.renter_user_id == customer.user_id).all()
-
-    # Use the merge sort helper function to show the latest rental first.
-    if len(rentals) > 1:
-        desc_date_rentals = reverse_merge_sort_histories(rentals)
-    else:
-        desc_date_rentals = rentals
+    # The rentals of this user's stuff and the stuff this user has rented are
+    # shown a page at a time, most recently requested first. The database does
+    # the sorting, and requests_cursor and rentals_cursor say where the pages
+    # after the first one start.
+    cursor_strings = {}
+    cursors = {}
+
+    for arg_name in ("requests_cursor", "rentals_cursor"):
+        cursor_string = request.args.get(arg_name)
+
+        if cursor_string:
+            try:
+                cursors[arg_name] = decode_history_cursor(cursor_string)
+            except ValueError:
+                flash("Invalid history page. Showing the most recent rentals.")
+                continue
+
+            cursor_strings[arg_name] = cursor_string
+
+    desc_date_histories, next_requests_cursor = get_owner_histories(
+        customer.user_id, cursors.get("requests_cursor"))
+    desc_date_rentals, next_rentals_cursor = get_renter_histories(
+        customer.user_id, cursors.get("rentals_cursor"))
+
+    # "Older" links for tables with another page. These keep the other table
+    # on the page it's on now.
+    older_pages = {}
+
+    for arg_name, next_cursor in (("requests_cursor", next_requests_cursor),
+                                  ("rentals_cursor", next_rentals_cursor)):
+        if next_cursor:
+            page_args = dict(cursor_strings)
+            page_args[arg_name] = next_cursor
+            older_pages[arg_name] = '/account-info?' + urlencode(page_args)
 
     return render_template("account-info.html", user=customer, state=st,
                            products_available=products_avail,
                            products_not_available=products_out,
                            desc_order_hist=desc_date_histories,
                            histories=desc_date_rentals, today=today_date, monthago=last30,
-                           monthfromnow=next30, phonenum=prettify_phone)
+                           monthfromnow=next30, phonenum=prettify_phone,
+                           older_pages=older_pages,
+                           paged=cursor_strings)
 
 
 @app.route('/confirm-deactivate-account')
@@ -218,6 +247,8 @@ def deactivate_account():
     db.session.commit()
     session.clear()
 
+    invalidate_search_results_for_products([product.prod_id for product in products])
+
     flash("Your account has been deactivated. Thank you for using Happy Camper!")
 
     return redirect('/')
@@ -228,10 +259,12 @@ def deactivate_account():
 def list_product(category_id):
     """Shows listing forms for various categories."""
 
-    # Get all brands in the database to show in the brand drop down.
-    all_brands = Brand.query.all()
+    # Brands aren't sent with the form. The brand and model fields ask
+    # /autocomplete for suggestions as the user types.
     # Pre-populate available dates.
     dates = calc_default_dates(30)
+    # Drop down data for the category-specific specs.
+    reference = get_reference_data()
 
     templates = {1: 'list-tent.html',
                  2: 'list-sleeping-bag.html',
@@ -240,14 +273,13 @@ def list_product(category_id):
 
     # If the user wants to list a tent, gets tent-specific spec requests.
     if category_id == 1:
-        all_best_uses = BestUse.query.all()
+        all_best_uses = reference.best_uses
         season_categories = {2: "2-season",
                              3: "3-season",
                              4: "4-season",
                              5: "5-season"}
 
         return render_template(templates[category_id],
-                               brands=all_brands,
                                submit_route='/handle-listing/%d' % category_id,
                                p_today=dates['today_string'],
                                p_month=dates['future_string'],
@@ -256,11 +288,10 @@ def list_product(category_id):
     # Similarly, if user wants to list a sleeping bag, get info needed to request
     # sleeping bag-specific specs.
     elif category_id == 2:
-        all_fill_types = FillType.query.all()
-        all_gender_types = Gender.query.all()
+        all_fill_types = reference.fill_types
+        all_gender_types = reference.genders
 
         return render_template(templates[category_id],
-                               brands=all_brands,
                                submit_route='/handle-listing/%d' % category_id,
                                p_today=dates['today_string'],
                                p_month=dates['future_string'],
@@ -270,11 +301,10 @@ def list_product(category_id):
      # And same thing for sleeping pads. Get specific stuff like pad types to
      # show in the template's drop down.
     elif category_id == 3:
-        all_pad_types = PadType.query.all()
-        all_best_uses = BestUse.query.all()
+        all_pad_types = reference.pad_types
+        all_best_uses = reference.best_uses
 
         return render_template(templates[category_id],
-                               brands=all_brands,
                                submit_route='/handle-listing/%d' % category_id,
                                p_today=dates['today_string'],
                                p_month=dates['future_string'],
@@ -294,6 +324,10 @@ def handle_listing(category_id):
     brand_num = int(request.form.get("brand_id"))
     brand_num = check_brand(brand_num)
 
+    if brand_num is None:
+        flash("Please enter a brand. Try again.")
+        return redirect('/list-product/%d' % category_id)
+
     parent_product = make_parent_product(brand_id=brand_num, category_id=category_id)
 
     db.session.add(parent_product)
@@ -311,6 +345,11 @@ def handle_listing(category_id):
     db.session.add(child_product)
     db.session.commit()
 
+    update_search_vector(parent_product.prod_id)
+
+    # The new listing might belong in cached searches around its owner.
+    invalidate_search_results_near(parent_product.owner.postalcode)
+
     flash("Listing successfully posted!")
     return redirect('/product-detail/%d' % parent_product.prod_id)
 
@@ -320,45 +359,40 @@ def handle_listing(category_id):
 def edit_listing(prod_id):
     """Shows category-specific edit forms."""
 
-    categories = {1: Tent.query.get(prod_id),
-                  2: SleepingBag.query.get(prod_id),
-                  3: SleepingPad.query.get(prod_id),
-                  }
-
     templates = {1: 'edit-tent.html',
                  2: 'edit-sleeping-bag.html',
                  3: 'edit-sleeping-pad.html',
                  }
 
-    parent_product = Product.query.get(prod_id)
+    # One query gets the product and its category-specific specs.
+    parent_product = Product.query.options(*for_product_detail()).get(prod_id)
     category_id = parent_product.cat_id
-    child_product = categories[category_id]
-
-    all_brands = Brand.query.all()
+    child_product = parent_product.details
+    reference = get_reference_data()
 
     if category_id == 1:
-        all_best_uses = BestUse.query.all()
+        all_best_uses = reference.best_uses
         season_categories = {2: "2-season",
                              3: "3-season",
                              4: "4-season",
                              5: "5-season"}
 
         return render_template(templates[category_id], parent=parent_product,
-                               child=child_product, brands=all_brands,
+                               child=child_product,
                                best_uses=all_best_uses, seasons=season_categories)
     elif category_id == 2:
-        all_fill_types = FillType.query.all()
-        all_genders = Gender.query.all()
+        all_fill_types = reference.fill_types
+        all_genders = reference.genders
 
         return render_template(templates[category_id], parent=parent_product,
-                               child=child_product, brands=all_brands,
+                               child=child_product,
                                fill_types=all_fill_types, genders=all_genders)
     elif category_id == 3:
-        all_pad_types = PadType.query.all()
-        all_best_uses = BestUse.query.all()
+        all_pad_types = reference.pad_types
+        all_best_uses = reference.best_uses
 
         return render_template(templates[category_id], parent=parent_product,
-                               child=child_product, brands=all_brands,
+                               child=child_product,
                                pad_types=all_pad_types, best_uses=all_best_uses)
 
     else:
@@ -377,6 +411,10 @@ def handle_edit_listing(prod_id):
     brand_num = int(request.form.get("brand_id"))
     brand_num = check_brand(brand_num)
 
+    if brand_num is None:
+        flash("Please enter a brand. Try again.")
+        return redirect('/edit-listing/%d' % prod_id)
+
     update_parent_product(prod_id=prod_id, brand_id=brand_num)
 
     if category_id == 1:
@@ -391,6 +429,11 @@ def handle_edit_listing(prod_id):
     else:
         return "This is unimplemented"
 
+    # The edit could take the product out of searches it was in, or put it in
+    # searches around its owner it wasn't in before.
+    invalidate_search_results_for_products([prod_id])
+    invalidate_search_results_near(parent_product.owner.postalcode)
+
     return redirect("/account-info")
 
 
@@ -398,8 +441,8 @@ def handle_edit_listing(prod_id):
 @app.route('/search-results')
 def show_results():
     """ Shows search results based on location and optional filters for
-        category and brand. Uses geolocation-python libary, which uses the
-        GoogleMaps API.
+        category and brand. Search centers that aren't in the database yet are
+        looked up with the offline geocoder (see geocoder.py).
 
     """
 
@@ -428,8 +471,31 @@ def show_results():
         return redirect('/success')
 
     search_area = request.args.get("search_area")
+
+    # Unknown zipcodes are looked up with the offline geocoder first.
+    if not get_search_center(search_area):
+        flash("Could not find postal code %s. Please try again." % search_area)
+        return redirect('/success')
+
     category_id = int(request.args.get("category_id"))
     brand_id = int(request.args.get("brand_id"))
+    keywords = request.args.get("keywords", "").strip()
+
+    # Categories past their first page of results have a cursor_<cat_id>
+    # argument saying where the next page starts.
+    cursor_strings = {}
+    cursors = {}
+
+    for arg_name, cursor_string in request.args.iteritems():
+        if arg_name.startswith("cursor_") and cursor_string:
+            try:
+                cursor_cat_id = int(arg_name[len("cursor_"):])
+                cursors[cursor_cat_id] = decode_cursor(cursor_string)
+            except ValueError:
+                flash("Invalid search results page. Showing the first page.")
+                continue
+
+            cursor_strings[cursor_cat_id] = cursor_string
 
     # This is the number of rental days.
     days = (search_end_date - search_start_date).days + 1
@@ -443,59 +509,80 @@ def show_results():
     session['search_radius'] = search_miles
     session['search_category_id'] = category_id
     session['search_brand_id'] = brand_id
+    session['search_keywords'] = keywords
 
-    # Find distinct postal codes in the database.
-    query = db.session.query(User.postalcode).distinct()
-    postalcodes = query.all()
-
-    # Get zipcodes in the database that are within the search radius.
-    # This uses a helper function in search_helpers, which in turn uses
-    # the geolocation-python library.
-    # In future version of project, save these distance searches in the
-    # database.
-    postal_codes = search_radius(search_center=search_area,
-                                 postalcodes=postalcodes, radius=search_miles)
-    # We use list of zipcodes we get above and to then get users within in those
-    # zipcodes. We remove the logged in user so we don't show his or her own
-    # products.
+    # Find a page of available products near the search center that match
+    # the search dates and the optional category and brand filters. This is
+    # one query per category joining products, users, and saved zipcode
+    # distances (see search_helpers), or one query if the page is in the
+    # search results cache. Leaves out the logged in user's own products.
     logged_in_user = User.query.filter(User.email == session['user']).one()
-    users_in_area = get_users_in_area(postal_codes, logged_in_user.user_id)
-
-    # From the list of users we get above, get products those users have listed
-    # for rent and are currently available within the search dates.
-    available_products = get_products_within_dates(start_date=search_start_date,
-                                                   end_date=search_end_date,
-                                                   users=users_in_area)
-    # Filter out products based on optional category and brand filters.
-    filtered_products = filter_products(available_products, category_id=category_id,
-                                        brand_id=brand_id)
-    # Get categories of interest. If the vale is -1, the user is interested in
-    # all categories (can currently select only one or all.)
-    if category_id < 0:
-        search_categories = Category.query.all()
-    else:
-        search_categories = [Category.query.get(category_id)]
+    products_by_category, next_cursors = cached_search_products(
+        search_center_string=search_area, radius=search_miles,
+        user_id=logged_in_user.user_id, start_date=search_start_date,
+        end_date=search_end_date, category_id=category_id, brand_id=brand_id,
+        keywords=keywords, cursors=cursors)
+
+    # Make "more results" links for categories with another page. These keep
+    # the other categories on the page they're on now. urlencode only takes
+    # byte strings, so the keywords are encoded to UTF-8 first.
+    search_args = {'search_area': search_area,
+                   'search_miles': search_miles,
+                   'search_start_date': search_start_date.date().isoformat(),
+                   'search_end_date': search_end_date.date().isoformat(),
+                   'category_id': category_id,
+                   'brand_id': brand_id,
+                   'keywords': keywords.encode('utf-8'),
+                   }
+
+    for cursor_cat_id, cursor_string in cursor_strings.iteritems():
+        search_args['cursor_%d' % cursor_cat_id] = cursor_string
+
+    # Get all categories and brands to show in the drop downs in the re-search
+    # form on top of the search results page, along with how many products
+    # this search would find for each of them.
+    reference = get_reference_data()
+    all_categories = reference.categories
+    all_brands = reference.brands
+
+    category_counts, brand_counts = count_search_facets(
+        search_center_string=search_area, radius=search_miles,
+        user_id=logged_in_user.user_id, start_date=search_start_date,
+        end_date=search_end_date, category_id=category_id, brand_id=brand_id,
+        keywords=keywords)
 
-    # Make a dictionary of available products with categories as the keys of the
-    # dictionary.
-    products_by_category = categorize_products(categories=search_categories,
-                                               products=filtered_products)
+    category_ids = {}
+
+    for category in all_categories:
+        category_ids[category.cat_name] = category.cat_id
+
+    next_page_urls = {}
+
+    for category_name, cursor_string in next_cursors.iteritems():
+        if cursor_string:
+            cursor_cat_id = category_ids[category_name]
+            next_args = dict(search_args)
+            next_args['cursor_%d' % cursor_cat_id] = cursor_string
+            next_page_urls[category_name] = '/search-results?' + urlencode(next_args)
 
     # Create a list of sorted category names so we can display products by
     # category in some kind of consistent order.
     sorted_category_names = sorted(products_by_category.keys())
 
-    # Get all categories and brands to show in the drop downs in the re-search
-    # form on top of the search results page.
-    all_categories = Category.query.all()
-    all_brands = Brand.query.all()
+    # Average star ratings for the product cards, in one query.
+    prod_ids = [row.prod_id for rows in products_by_category.values() for row in rows]
+    product_ratings = get_rating_summaries('product', prod_ids)
 
     return render_template("search-results.html", location=search_area,
                            miles=search_miles,
                            search_categories=sorted_category_names,
                            products=products_by_category,
+                           product_ratings=product_ratings,
+                           next_pages=next_page_urls,
                            product_categories=all_categories,
-                           product_brands=all_brands)
+                           product_brands=all_brands,
+                           category_counts=category_counts,
+                           brand_counts=brand_counts)
 
 
 ######################## Showing stuff ###################################
@@ -505,21 +592,18 @@ def show_product(prod_id):
         search results page.
     """
     # Use a different template based on category.
-    categories = {1: Tent.query.get(prod_id),
-                  2: SleepingBag.query.get(prod_id),
-                  3: SleepingPad.query.get(prod_id),
-                  }
-
     templates = {1: 'show-tent.html',
                  2: 'show-sleeping-bag.html',
                  3: 'show-sleeping-pad.html',
                  }
 
-    parent_product = Product.query.get(prod_id)
+    # One query gets the product, its category-specific specs, and everything
+    # else the template shows.
+    parent_product = Product.query.options(*for_product_detail()).get(prod_id)
 
     category_id = parent_product.cat_id
 
-    child_product = categories[category_id]
+    child_product = parent_product.details
 
     # We show different things if the user is the owner vs. not the owner.
     try:
@@ -547,23 +631,26 @@ def confirm_rental(prod_id):
 
 @app.route('/handle-rental/<int:prod_id>', methods=['POST'])
 def handle_rental(prod_id):
-    """ Processes a rental. Create associated History object and marks the
-        product as unavailable so it doesn't show up in future search results
-        until the owner actively relists it.
+    """ Processes a rental. Books the product for the search dates by creating
+        the associated History object, unless someone else has already booked
+        it for any of those dates. The product stays available for other
+        dates.
 
     """
     user = User.query.filter(User.email == session['user']).one()
-    product = Product.query.get(prod_id)
-    cost = product.price_per_day * session['num_days']
 
-    history = History(prod_id=prod_id, renter_user_id=user.user_id,
-                      start_date=session['search_start_date'],
-                      end_date=session['search_end_date'],
-                      total_cost=cost)
+    # book_product locks the product while it checks and books, so two
+    # renters can't get the same dates.
+    history = book_product(prod_id=prod_id, renter_user_id=user.user_id,
+                           start_date=session['search_start_date'],
+                           end_date=session['search_end_date'],
+                           num_days=session['num_days'])
 
-    product.available = False
-    db.session.add(history)
-    db.session.commit()
+    if not history:
+        flash("Sorry, this item was just booked for some of those dates. Please search again.")
+        return redirect('/product-detail/%d' % prod_id)
+
+    invalidate_search_results_for_products([prod_id])
 
     flash("Rental finalized! Check your account page under \"Items Rented\" for info.")
 
@@ -576,39 +663,41 @@ def show_owner_ratings(user_id):
     """Shows owner star ratings and any comments."""
 
     owner = User.query.get(user_id)
-    products = owner.products
 
-    owner_ratings = []
-
-    # Ratings are optional, so we have to check if there are any.
-    for product in products:
-        for history in product.histories:
-            if history.owner_rating:
-                owner_ratings.append(history.owner_rating)
+    # Ratings are optional, so only get histories that have one.
+    owner_ratings = Rating.query.join(
+        History, History.owner_rating_id == Rating.rating_id).join(
+        Product, Product.prod_id == History.prod_id).filter(
+        Product.owner_user_id == user_id).order_by(
+        History.rental_submission_date.desc()).options(
+        *for_rating_rows('owner')).all()
 
-    avg_star_rating = calc_avg_star_rating(owner_ratings)
+    # The average comes from the running totals in rating_summaries instead
+    # of adding up every rating.
+    summary = get_rating_summary('owner', user_id)
 
     return render_template("show-owner-ratings.html", ratings=owner_ratings,
-                           average=avg_star_rating, prod=product)
+                           average=summary.average(), summary=summary,
+                           owner=owner)
 
 
 @app.route('/show-renter-ratings/<int:renter_id>')
 def show_renter_ratings(renter_id):
     """Shows renter star ratings and any comments."""
 
-    histories = History.query.filter(History.renter_user_id == renter_id).all()
     renter = User.query.get(renter_id)
 
-    renter_ratings = []
+    renter_ratings = Rating.query.join(
+        History, History.renter_rating_id == Rating.rating_id).filter(
+        History.renter_user_id == renter_id).order_by(
+        History.rental_submission_date.desc()).options(
+        *for_rating_rows('renter')).all()
 
-    for history in histories:
-        if history.renter_rating:
-            renter_ratings.append(history.renter_rating)
-
-    avg_star_rating = calc_avg_star_rating(renter_ratings)
+    summary = get_rating_summary('renter', renter_id)
 
     return render_template("show-renter-ratings.html", ratings=renter_ratings,
-                           average=avg_star_rating, user=renter)
+                           average=summary.average(), summary=summary,
+                           user=renter)
 
 
 @app.route('/show-product-ratings/<int:prod_id>')
@@ -616,18 +705,17 @@ def show_product_ratings(prod_id):
     """Shows product star ratings and any comments."""
 
     item = Product.query.get(prod_id)
-    histories = History.query.filter(History.prod_id == prod_id).all()
-
-    product_ratings = []
 
-    for history in histories:
-        if history.product_rating:
-            product_ratings.append(history.product_rating)
+    product_ratings = Rating.query.join(
+        History, History.prod_rating_id == Rating.rating_id).filter(
+        History.prod_id == prod_id).order_by(
+        History.rental_submission_date.desc()).all()
 
-    avg_star_rating = calc_avg_star_rating(product_ratings)
+    summary = get_rating_summary('product', prod_id)
 
     return render_template("show-product-ratings.html", ratings=product_ratings,
-                           average=avg_star_rating, product=item)
+                           average=summary.average(), summary=summary,
+                           product=item)
 
 
 @app.route('/rate-user-modal/<int:user_id>-<int:history_id>-<int:owner_is_true>')
@@ -681,15 +769,27 @@ def handle_owner_rating():
     rating = Rating(stars=number_stars, comments=comments_text)
 
     db.session.add(rating)
-    db.session.commit()
+    # Flush to get the rating_id, but don't commit until the history and the
+    # rating summary are updated too.
+    db.session.flush()
 
     history = History.query.get(history_id)
 
     if is_owner:
+        kind = 'owner'
+        old_rating = history.owner_rating
         history.owner_rating_id = rating.rating_id
     else:
+        kind = 'renter'
+        old_rating = history.renter_rating
         history.renter_rating_id = rating.rating_id
 
+    # If this replaces an earlier rating, take the old stars out of the
+    # summary.
+    old_stars = old_rating.stars if old_rating else None
+    update_rating_summary(kind, rating_subject_id(kind, history), number_stars,
+                          old_stars)
+
     db.session.commit()
 
     # The form stays on the account-info page, so user does not see below.
@@ -732,11 +832,15 @@ def handle_product_rating():
 
     product_rating = Rating(stars=number_stars, comments=comments_text)
     db.session.add(product_rating)
-    db.session.commit()
+    db.session.flush()
 
     history = History.query.get(history_id)
+    old_rating = history.product_rating
     history.prod_rating_id = product_rating.rating_id
 
+    old_stars = old_rating.stars if old_rating else None
+    update_rating_summary('product', history.prod_id, number_stars, old_stars)
+
     db.session.commit()
 
     return "Product rating id=%d submitted for history_id=%d" % (
@@ -764,11 +868,66 @@ def delist_product():
     product.available = False
     db.session.commit()
 
+    invalidate_search_results_for_products([prod_id])
+
     flash("This product has been delisted.")
 
     return redirect('/account-info')
 
 
+######################## Autocomplete stuff ###############################
+@app.route('/autocomplete')
+def autocomplete():
+    """ Suggests brand or model names for the listing forms.
+
+        Takes field ("brand" or "model") and q (what the user has typed so far)
+        as arguments, and returns JSON with a list of results, each with a
+        name and the brand_id of the brand (or the model's brand).
+
+    """
+
+    field = request.args.get("field", "brand")
+    prefix = request.args.get("q", "")
+
+    if field == "model":
+        index = get_model_index()
+    else:
+        index = get_brand_index()
+
+    results = [{'name': name, 'brand_id': brand_id}
+               for name, brand_id in index.search(prefix)]
+
+    return jsonify(results=results)
+
+
+######################## Monitoring stuff ###################################
+@app.route('/geocode-stats')
+def show_geocode_stats():
+    """ Shows geocoding cache counters as JSON, so we can see how many
+        GoogleMaps calls the cache is saving.
+    """
+
+    return jsonify(geocode_cache.stats())
+
+
+@app.route('/search-cache-stats')
+def show_search_cache_stats():
+    """Shows search results cache counters as JSON."""
+
+    return jsonify(search_result_cache.stats())
+
+
+@app.route('/db-pool-stats')
+def show_db_pool_stats():
+    """ Shows database connection pool counters as JSON: checkouts, how long
+        they waited for a connection, timeouts, and connections in use. If
+        waits or timeouts go up, the pool is too small for the number of
+        requests each worker handles.
+    """
+
+    return jsonify(pool_metrics.stats(db.engine.pool))
+
+
 ######################################################################
 if __name__ == "__main__":
 